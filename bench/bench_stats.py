@@ -0,0 +1,80 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from freeze_bits_and_compute_stats import (
+    bytes_to_bits,
+    compute_bitset_stats,
+    find_dense_regions,
+    find_longest_streaks,
+)
+
+# Compares the string-walking stats in freeze_bits_and_compute_stats.py with the
+# bitarray ones on a handful of bitsets, and checks that they agree.
+#
+#   python bench/bench_stats.py [repeats]
+
+TOTAL_BYTES = 125_000
+
+def random_bitset(density):
+    rng = random.Random(1234)
+    return bytes(
+        sum(1 << bit for bit in range(8) if rng.random() < density)
+        for _ in range(TOTAL_BYTES)
+    )
+
+def long_run_bitset():
+    raw = bytearray(random_bitset(0.5))
+    raw[40_000:90_000] = b"\xff" * 50_000
+    raw[100_000:100_500] = b"\x00" * 500
+    return bytes(raw)
+
+BITSETS = {
+    "random 50%": lambda: random_bitset(0.5),
+    "random 99%": lambda: random_bitset(0.99),
+    "alternating": lambda: b"\x55" * TOTAL_BYTES,
+    "all zeros": lambda: b"\x00" * TOTAL_BYTES,
+    "all ones": lambda: b"\xff" * TOTAL_BYTES,
+    "one long run": long_run_bitset,
+}
+
+def old_stats(raw):
+    bitstring = bytes_to_bits(raw)
+    streaks = find_longest_streaks(bitstring)
+    return (
+        len(list(x for x in bitstring if x == "0")),
+        streaks,
+        find_dense_regions(bitstring, bit_kind="0"),
+        find_dense_regions(bitstring, bit_kind="1"),
+    )
+
+def new_stats(raw):
+    stats = compute_bitset_stats(raw)
+    return (
+        stats.zeros,
+        [list(stats.longest_zeros), list(stats.longest_ones)],
+        [tuple(region) for region in stats.dense_zeros],
+        [tuple(region) for region in stats.dense_ones],
+    )
+
+def timed(fn, raw, repeats):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn(raw)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"{'bitset':<14} {'old':>10} {'new':>10} {'speedup':>9}  match")
+    for name, make in BITSETS.items():
+        raw = make()
+        old_result, old_time = timed(old_stats, raw, repeats)
+        new_result, new_time = timed(new_stats, raw, repeats)
+        print(f"{name:<14} {old_time * 1000:>8.1f}ms {new_time * 1000:>8.2f}ms "
+              f"{old_time / new_time:>8.0f}x  {old_result == new_result}")
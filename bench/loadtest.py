@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+import socketio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from checkbox_log import iter_day
+from toggle_codec import decode_toggles, is_binary
+
+# Drives simulated Socket.IO clients against a server.py worker and reports
+# toggle-to-broadcast latency, throughput, bytes received and worker CPU/memory.
+#
+#   python bench/loadtest.py --clients 100 --rate 2 --duration 30
+#   python bench/loadtest.py --redis --env BATCH_TOGGLES=true
+#   python bench/loadtest.py --redis --shards 4               # one redis-server per shard
+#   python bench/loadtest.py --replay-dir checkbox_logs --replay-day 2024-07-01 --speed 10
+#   python bench/loadtest.py --url http://localhost:5001      # an already running server
+#
+# Needs the packages in bench/requirements.txt on top of the server's.
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+TOTAL_CHECKBOXES = 1_000_000
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + "/api/initial-state", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} never came up")
+
+def process_tree(pid):
+    pids = [pid]
+    for child_pid in pids:
+        try:
+            with open(f"/proc/{child_pid}/task/{child_pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def cpu_and_rss(pid):
+    # user + system cpu seconds and resident memory in bytes, summed over the worker and its children
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    cpu = 0
+    rss = 0
+    for child_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{child_pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page_size
+        except (OSError, IndexError):
+            pass
+    return cpu, rss
+
+def start_redis(port):
+    redis_server = shutil.which("redis-server")
+    if redis_server is None:
+        raise RuntimeError("--redis needs redis-server on the PATH, or point --redis-port at one that is running")
+    process = subprocess.Popen(
+        [redis_server, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return process
+
+def start_server(port, env, log_dir):
+    # same worker setup as start_gunicorn.sh, one eventlet worker
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--worker-class", "eventlet", "--workers", "1",
+         "--bind", f"127.0.0.1:{port}", "server:app"],
+        # every client connects from 127.0.0.1, which would otherwise get throttled as one heavy hitter.
+        # logs, the shared bitset and its snapshots all go in the temporary directory, not the real ones
+        cwd=ROOT, env={**os.environ, "CHECKBOX_LOG_DIR": log_dir, "HEAVY_HITTERS": "false",
+                       "SHARED_STATE_DIR": os.path.join(log_dir, "shared"),
+                       "PERSIST_DIR": os.path.join(log_dir, "state"), **env},
+        stdout=subprocess.DEVNULL, stderr=open(os.path.join(log_dir, "server.log"), "w"))
+    return process
+
+def load_replay(args):
+    # (seconds from start, index, ip) for every logged toggle
+    if args.replay_dir:
+        entries = [(timestamp / 1000, index, ip) for timestamp, ip, index, _ in iter_day(args.replay_dir, args.replay_day)]
+    else:
+        import redis
+        r = redis.Redis(host=args.replay_redis_host, port=args.replay_redis_port)
+        entries = []
+        start = 0
+        while True:
+            chunk = r.lrange(f"checkbox_logs:{args.replay_day}", start, start + 9999)
+            if not chunk:
+                break
+            for line in chunk:
+                timestamp, ip, index, _ = line.decode().split("|")
+                entries.append((datetime.fromisoformat(timestamp).timestamp(), int(index), ip))
+            start += len(chunk)
+    if not entries:
+        raise RuntimeError("nothing to replay")
+    first = entries[0][0]
+    return [((timestamp - first) / args.speed, index, ip) for timestamp, index, ip in entries]
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.rejected = 0
+        self.latencies = []
+        self.bytes_received = 0
+        self.batches_received = 0
+        self.full_states = 0
+
+class Client:
+    def __init__(self, url, stats, binary):
+        self.url = url
+        self.stats = stats
+        self.binary = binary
+        self.pending = {}
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("batched_bit_toggles", self.on_batch)
+        self.sio.on("full_state", self.on_full_state)
+
+    async def connect(self):
+        url = self.url + ("?wire=binary" if self.binary else "")
+        await self.sio.connect(url, transports=["websocket"])
+
+    def on_batch(self, data):
+        now = time.time()
+        if is_binary(data):
+            self.stats.bytes_received += len(data)
+            true_updates, false_updates, _ = decode_toggles(data)
+        else:
+            self.stats.bytes_received += len(json.dumps(data))
+            true_updates, false_updates, _ = data
+        self.stats.batches_received += 1
+        for index in true_updates + false_updates:
+            sent_at = self.pending.pop(index, None)
+            if sent_at is not None:
+                self.stats.latencies.append(now - sent_at)
+
+    def on_full_state(self, data):
+        self.stats.full_states += 1
+        self.stats.bytes_received += len(json.dumps(data))
+
+    async def toggle(self, index):
+        self.pending[index] = time.time()
+        self.stats.sent += 1
+        await self.sio.emit("toggle_bit", {"index": index}, callback=self.on_ack(index))
+
+    def on_ack(self, index):
+        def ack(*result):
+            # handle_toggle only answers with False when it refused the toggle
+            if result and result[0] is False:
+                self.stats.rejected += 1
+                self.pending.pop(index, None)
+        return ack
+
+    async def run_random(self, rate, duration):
+        deadline = time.time() + duration
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.time() >= deadline:
+                return
+            await self.toggle(random.randrange(TOTAL_CHECKBOXES))
+
+    async def run_replay(self, entries):
+        started = time.time()
+        for offset, index, _ in entries:
+            delay = started + offset - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.toggle(index)
+
+async def run(args, url):
+    stats = Stats()
+    clients = [Client(url, stats, args.binary) for _ in range(args.clients)]
+    await asyncio.gather(*(client.connect() for client in clients))
+
+    started = time.time()
+    if args.replay_dir or args.replay_redis_host:
+        # keep each ip on one client so per-ip ordering (and rate limiting) looks like production
+        entries = load_replay(args)
+        per_client = [[] for _ in clients]
+        for entry in entries:
+            per_client[hash(entry[2]) % len(clients)].append(entry)
+        await asyncio.gather(*(client.run_replay(mine) for client, mine in zip(clients, per_client)))
+    else:
+        await asyncio.gather(*(client.run_random(args.rate, args.duration) for client in clients))
+    # give the last batches a moment to come back
+    await asyncio.sleep(args.drain)
+    elapsed = time.time() - started
+
+    await asyncio.gather(*(client.sio.disconnect() for client in clients))
+    return stats, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO toggle load test")
+    parser.add_argument("--url", help="use a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--redis", action="store_true", help="run the worker in redis mode against a local redis-server")
+    parser.add_argument("--redis-port", type=int, default=6399)
+    parser.add_argument("--shards", type=int, default=1, help="split the boxes over this many redis-servers, on consecutive ports")
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the worker, repeatable")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=2, help="toggles per second per client")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--drain", type=float, default=2)
+    parser.add_argument("--binary", action="store_true", help="negotiate binary toggle frames")
+    parser.add_argument("--replay-dir", help="replay a day of file logs from this CHECKBOX_LOG_DIR")
+    parser.add_argument("--replay-redis-host", help="replay a day of checkbox_logs:<day> from this redis")
+    parser.add_argument("--replay-redis-port", type=int, default=6379)
+    parser.add_argument("--replay-day", help="YYYY-MM-DD to replay")
+    parser.add_argument("--speed", type=float, default=1, help="replay this many times faster than recorded")
+    parser.add_argument("--json", help="also write the results here, for comparing runs")
+    args = parser.parse_args()
+
+    processes = []
+    log_dir = tempfile.mkdtemp(prefix="loadtest-")
+    url = args.url
+    try:
+        if url is None:
+            env = dict(item.split("=", 1) for item in args.env)
+            if args.redis:
+                ports = [args.redis_port + i for i in range(args.shards)]
+                for port in ports:
+                    processes.append(start_redis(port))
+                env.update(USE_REDIS="true", REDIS_SSL="false", REDIS_HOST="127.0.0.1",
+                           REDIS_PORT=str(args.redis_port), REDIS_REPLICA_HOSTS=f"127.0.0.1:{args.redis_port}")
+                if args.shards > 1:
+                    env["REDIS_SHARDS"] = ",".join(f"127.0.0.1:{port}/127.0.0.1:{port}" for port in ports)
+            server = start_server(args.port, env, log_dir)
+            processes.append(server)
+            url = f"http://127.0.0.1:{args.port}"
+        wait_for(url)
+
+        before = cpu_and_rss(server.pid) if args.url is None else None
+        stats, elapsed = asyncio.run(run(args, url))
+        after = cpu_and_rss(server.pid) if args.url is None else None
+    finally:
+        for process in reversed(processes):
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    latencies_ms = [latency * 1000 for latency in stats.latencies]
+    results = {
+        "clients": args.clients,
+        "elapsed_s": round(elapsed, 2),
+        "sent": stats.sent,
+        "rejected": stats.rejected,
+        "confirmed": len(latencies_ms),
+        "toggles_per_s": round(stats.sent / elapsed, 1),
+        "latency_ms": {p: round(percentile(latencies_ms, p), 1) for p in (50, 90, 99)},
+        "latency_max_ms": round(max(latencies_ms, default=0), 1),
+        "batches_received": stats.batches_received,
+        "full_states_received": stats.full_states,
+        "bytes_received": stats.bytes_received,
+        "bytes_per_client_per_s": round(stats.bytes_received / args.clients / elapsed),
+    }
+    if before and after:
+        results["worker_cpu_s"] = round(after[0] - before[0], 2)
+        results["worker_cpu_percent"] = round(100 * (after[0] - before[0]) / elapsed, 1)
+        results["worker_rss_mb"] = round(after[1] / 1024 / 1024, 1)
+
+    for key, value in results.items():
+        print(f"{key:>24}: {value}")
+    print(f"{'server log':>24}: {os.path.join(log_dir, 'server.log')}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
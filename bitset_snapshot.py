@@ -0,0 +1,213 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from bitarray import bitarray
+from bitarray.util import zeros
+
+# On-disk copy of the checkbox bitset, so a restarted worker can serve straight away
+# instead of waiting on redis or starting from nothing:
+#
+#   <dir>/bitset.snapshot                 the whole bitset as of some moment, see below
+#   <dir>/journal/<writer>.<n>.jnl        every toggle a worker applied locally since then
+#
+# The snapshot is a header followed by the raw bitset, big-endian bits like redis:
+#
+#   magic "CBSN" | version (uint16) | size in bits (uint32) | count (uint32)
+#   timestamp ms (uint64) | crc32 of the bitset (uint32)
+#
+# It's written to a temporary file and renamed over the old one, so readers only ever
+# see a whole snapshot. Journal files are runs of fixed-size records:
+#
+#   timestamp ms (uint64) | checkbox index (uint32) | value (uint8)
+#
+# stamped when the toggle was applied in this process, after the bit changed. So
+# everything stamped before the snapshot's timestamp is already in it, and restoring
+# is "load the snapshot, replay journal records from its timestamp on". Records hold
+# the new value rather than a flip, so replaying one twice is harmless.
+#
+# Everything is little-endian, and a torn record at the end of a journal is ignored.
+
+SNAPSHOT_MAGIC = b"CBSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHIIQI")
+JOURNAL_RECORD = struct.Struct("<QIB")
+# journal records this close before the snapshot get replayed anyway, in case the clock stepped
+REPLAY_MARGIN_MS = 1000
+
+class BitsetSnapshot:
+    def __init__(self, raw, count, timestamp):
+        self.raw = raw
+        self.count = count
+        self.timestamp = timestamp
+
+def write_snapshot(path, raw, timestamp):
+    bits = bitarray(endian="big")
+    bits.frombytes(raw)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(bits), bits.count(),
+                                  timestamp, zlib.crc32(raw))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(path):
+    # None if there is no snapshot or it doesn't check out
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, size, count, timestamp, crc = SNAPSHOT_HEADER.unpack_from(mm, 0)
+            raw = mm[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + size // 8]
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or len(raw) != size // 8:
+        print(f"Ignoring snapshot {path}, it isn't a version {SNAPSHOT_VERSION} snapshot")
+        return None
+    if zlib.crc32(raw) != crc:
+        print(f"Ignoring snapshot {path}, its checksum doesn't match")
+        return None
+    return BitsetSnapshot(raw, count, timestamp)
+
+def journal_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".jnl"))
+
+def iter_journal_file(path, since=0):
+    with open(path, "rb") as f:
+        data = f.read()
+    whole = len(data) - len(data) % JOURNAL_RECORD.size
+    for timestamp, index, value in JOURNAL_RECORD.iter_unpack(data[:whole]):
+        if timestamp >= since:
+            yield timestamp, index, value
+
+def last_journal_timestamp(path):
+    # a writer appends its records in the order it stamps them, so the last whole one is the newest
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        whole = size - size % JOURNAL_RECORD.size
+        if whole == 0:
+            return None
+        f.seek(whole - JOURNAL_RECORD.size)
+        timestamp, _, _ = JOURNAL_RECORD.unpack(f.read(JOURNAL_RECORD.size))
+    return timestamp
+
+def iter_journal(directory, since=0):
+    # every writer's records from `since` on, in timestamp order
+    records = []
+    for path in journal_files(directory):
+        records.extend(iter_journal_file(path, since))
+    records.sort(key=lambda record: record[0])
+    return records
+
+class Journal:
+    def __init__(self, directory, writer, roll_seconds):
+        self.directory = directory
+        self.writer = writer
+        self.roll_seconds = roll_seconds
+        self.buffer = bytearray()
+        self.path = None
+        self.opened_at = 0
+
+    def record(self, index, value, timestamp):
+        self.buffer += JOURNAL_RECORD.pack(timestamp, index, 1 if value else 0)
+
+    def flush(self):
+        if not self.buffer:
+            return 0
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        if self.path is None or time.time() - self.opened_at >= self.roll_seconds:
+            # a fresh file every so often, so old ones can be deleted once a snapshot covers them
+            os.makedirs(self.directory, exist_ok=True)
+            self.opened_at = time.time()
+            self.path = os.path.join(self.directory, f"{self.writer}.{int(self.opened_at * 1000)}.jnl")
+        # reopened every time, so a file pruned out from under us just gets created again
+        with open(self.path, "ab") as f:
+            f.write(data)
+        return len(data) // JOURNAL_RECORD.size
+
+class BitsetPersistence:
+    def __init__(self, directory, writer, roll_seconds=60):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, "bitset.snapshot")
+        self.journal_directory = os.path.join(directory, "journal")
+        self.journal = Journal(self.journal_directory, writer, roll_seconds)
+        self.lock_file = None
+
+    def record(self, index, value):
+        self.journal.record(index, value, int(time.time() * 1000))
+
+    def record_many(self, true_updates, false_updates):
+        timestamp = int(time.time() * 1000)
+        for index in true_updates:
+            self.journal.record(index, True, timestamp)
+        for index in false_updates:
+            self.journal.record(index, False, timestamp)
+
+    def flush(self):
+        return self.journal.flush()
+
+    def is_leader(self):
+        # one process per directory writes snapshots, whoever holds the lock file
+        if self.lock_file is None:
+            lock_file = open(os.path.join(self.directory, "snapshot.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file
+        return True
+
+    def snapshot(self, get_raw_state):
+        if not self.is_leader():
+            return None
+        # stamped before reading the bitset, so it can't be later than anything the copy misses
+        timestamp = int(time.time() * 1000)
+        raw = get_raw_state()
+        write_snapshot(self.snapshot_path, raw, timestamp)
+        self.prune(timestamp - REPLAY_MARGIN_MS)
+        return timestamp
+
+    def prune(self, before):
+        # a file goes once its newest record is older than the snapshot, going by the
+        # records themselves rather than when the file was last touched
+        for path in journal_files(self.journal_directory):
+            try:
+                last = last_journal_timestamp(path)
+                if last is None:
+                    last = os.path.getmtime(path) * 1000
+                if last < before:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def restore(self, size):
+        # (bitset as of the last journal record, records replayed), or None if there's nothing on disk
+        snapshot = read_snapshot(self.snapshot_path)
+        bits = zeros(size, endian="big")
+        since = 0
+        if snapshot is not None:
+            loaded = bitarray(endian="big")
+            loaded.frombytes(snapshot.raw)
+            bits[:min(size, len(loaded))] = loaded[:size]
+            since = snapshot.timestamp - REPLAY_MARGIN_MS
+
+        records = iter_journal(self.journal_directory, since)
+        if snapshot is None and not records:
+            return None
+        for _, index, value in records:
+            if index < size:
+                bits[index] = value
+        return bits, len(records)
@@ -0,0 +1,206 @@
+import heapq
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime
+
+# Append-only checkbox toggle log, one directory per day and one set of files per writer:
+#
+#   <dir>/<YYYY-MM-DD>/<writer>.log   blocks of toggles, see below
+#   <dir>/<YYYY-MM-DD>/<writer>.ips   one "<id> <ip>" line per ip, ids count up from 0
+#   <dir>/<YYYY-MM-DD>/<writer>.idx   one "<hour> <offset>" line for the first block of each hour
+#
+# Each flush writes one columnar block:
+#
+#   magic "CBLK" | base timestamp ms (uint64) | count (uint32)
+#   count timestamp deltas from the base, in ms (uint32)
+#   count ip ids (uint32)
+#   count checkbox indices (uint32)
+#   ceil(count / 8) bytes of checked states, one bit per toggle, lowest bit first
+#
+# All integers are little-endian. Blocks never span two days.
+
+BLOCK_MAGIC = b"CBLK"
+BLOCK_HEADER = struct.Struct("<4sQI")
+
+def day_for(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y-%m-%d")
+
+def hour_for(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000).hour
+
+def _column(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+def _read_column(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+def _pack_states(states):
+    packed = bytearray((len(states) + 7) // 8)
+    for i, state in enumerate(states):
+        if state:
+            packed[i // 8] |= 1 << (i % 8)
+    return bytes(packed)
+
+class CheckboxLogWriter:
+    def __init__(self, directory, writer):
+        self.directory = directory
+        self.writer = writer
+        self.buffer = []
+        self.day = None
+        self.log_file = None
+        self.ips_file = None
+        self.idx_file = None
+        self.ip_ids = {}
+        self.hours = set()
+
+    def append(self, remote_ip, checkbox_index, checked_state, timestamp_ms):
+        self.buffer.append((timestamp_ms, remote_ip, checkbox_index, checked_state))
+
+    def flush(self):
+        entries = self.buffer
+        self.buffer = []
+        if not entries:
+            return 0
+
+        # entries are in arrival order, split them wherever the day changes
+        block = []
+        for entry in entries:
+            if block and day_for(entry[0]) != day_for(block[0][0]):
+                self.write_block(block)
+                block = []
+            block.append(entry)
+        self.write_block(block)
+
+        self.idx_file.flush()
+        self.log_file.flush()
+        return len(entries)
+
+    def open_day(self, day):
+        self.close()
+        path = os.path.join(self.directory, day)
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, self.writer)
+
+        self.ip_ids = {}
+        if os.path.exists(base + ".ips"):
+            for ip_id, ip in iter_ips(base + ".ips"):
+                self.ip_ids[ip] = ip_id
+        self.hours = set()
+        if os.path.exists(base + ".idx"):
+            self.hours = set(hour for hour, _ in iter_hour_index(base + ".idx"))
+
+        self.log_file = open(base + ".log", "ab")
+        self.ips_file = open(base + ".ips", "a")
+        self.idx_file = open(base + ".idx", "a")
+        self.day = day
+
+    def write_block(self, block):
+        base_ts = block[0][0]
+        day = day_for(base_ts)
+        if day != self.day:
+            self.open_day(day)
+
+        ip_ids = []
+        new_ips = False
+        for _, remote_ip, _, _ in block:
+            if remote_ip not in self.ip_ids:
+                self.ip_ids[remote_ip] = len(self.ip_ids)
+                self.ips_file.write(f"{self.ip_ids[remote_ip]} {remote_ip}\n")
+                new_ips = True
+            ip_ids.append(self.ip_ids[remote_ip])
+        # out before any of the block is, the log file's buffer can spill at any write,
+        # and a reader should never see a block whose ip ids it can't resolve
+        if new_ips:
+            self.ips_file.flush()
+
+        offset = self.log_file.tell()
+        hour = hour_for(base_ts)
+        if hour not in self.hours:
+            self.hours.add(hour)
+            self.idx_file.write(f"{hour} {offset}\n")
+
+        self.log_file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, base_ts, len(block)))
+        self.log_file.write(_column("I", [max(ts - base_ts, 0) for ts, _, _, _ in block]))
+        self.log_file.write(_column("I", ip_ids))
+        self.log_file.write(_column("I", [index for _, _, index, _ in block]))
+        self.log_file.write(_pack_states([state for _, _, _, state in block]))
+
+    def close(self):
+        for f in (self.log_file, self.ips_file, self.idx_file):
+            if f is not None:
+                f.close()
+        self.log_file = self.ips_file = self.idx_file = None
+        self.day = None
+
+def iter_ips(path):
+    with open(path) as f:
+        for line in f:
+            ip_id, ip = line.rstrip("\n").split(" ", 1)
+            yield int(ip_id), ip
+
+def iter_hour_index(path):
+    with open(path) as f:
+        for line in f:
+            hour, offset = line.split()
+            yield int(hour), int(offset)
+
+def block_size(count):
+    return BLOCK_HEADER.size + count * 12 + (count + 7) // 8
+
+def iter_blocks(path, offset=0):
+    # yields (block offset, base timestamp, ts deltas, ip ids, indices, states) for every whole block
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            block_offset = f.tell()
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            magic, base_ts, count = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                raise ValueError(f"Corrupt block at {block_offset} in {path}")
+            body = f.read(block_size(count) - BLOCK_HEADER.size)
+            if len(body) < block_size(count) - BLOCK_HEADER.size:
+                return  # a writer is partway through this block
+            deltas = _read_column("I", body[:count * 4])
+            ip_ids = _read_column("I", body[count * 4:count * 8])
+            indices = _read_column("I", body[count * 8:count * 12])
+            packed = body[count * 12:]
+            states = [bool(packed[i // 8] >> (i % 8) & 1) for i in range(count)]
+            yield block_offset, base_ts, deltas, ip_ids, indices, states
+
+def iter_log_file(path, start_hour=None):
+    # yields (timestamp ms, ip, checkbox index, checked state), from the first block of start_hour on
+    base = path[:-len(".log")]
+    ips = dict(iter_ips(base + ".ips")) if os.path.exists(base + ".ips") else {}
+
+    offset = 0
+    if start_hour is not None and os.path.exists(base + ".idx"):
+        later = [offset for hour, offset in iter_hour_index(base + ".idx") if hour >= start_hour]
+        if not later:
+            return
+        offset = min(later)
+
+    for block_offset, base_ts, deltas, ip_ids, indices, states in iter_blocks(path, offset):
+        for i in range(len(indices)):
+            yield base_ts + deltas[i], ips.get(ip_ids[i], "UNKNOWN_IP"), indices[i], states[i]
+
+def log_files(directory, day):
+    path = os.path.join(directory, day)
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".log"))
+
+def iter_day(directory, day, start_hour=None):
+    # every writer's entries for the day, merged into timestamp order
+    streams = [iter_log_file(path, start_hour) for path in log_files(directory, day)]
+    return heapq.merge(*streams, key=lambda entry: entry[0])
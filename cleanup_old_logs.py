@@ -1,6 +1,13 @@
 import redis
 from datetime import datetime, timedelta
+import gzip
+import json
 import os
+import time
+
+ARCHIVE_DIR = os.environ.get("LOG_ARCHIVE_DIR", "log_archive")
+# LRANGE this many entries at a time, small enough not to stall redis on a 400M entry list
+CHUNK_SIZE = int(os.environ.get("LOG_ARCHIVE_CHUNK", "10000"))
 
 print(os.environ.get("REDIS_HOST"))
 redis_client = redis.Redis(
@@ -13,21 +20,80 @@ redis_client = redis.Redis(
 )
 print("connected to redis")
 
+def find_log_keys():
+    # SCAN instead of KEYS so we never block redis, and sort ourselves since SCAN has no order
+    keys = []
+    for key in redis_client.scan_iter(match="checkbox_logs:*", count=1000):
+        try:
+            key_date = datetime.strptime(key.decode().split(':')[1], '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        keys.append((key_date, key))
+    return sorted(keys)
+
+def archive_key(key, archive_path):
+    # Streams the list into a gzip file. Progress is checkpointed next to the archive
+    # after every chunk, so an interrupted run picks up where it stopped.
+    progress_path = archive_path + ".progress"
+    offset = 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        offset = progress["offset"]
+        # drop anything written after the last checkpoint, it gets written again
+        with open(archive_path, "ab") as f:
+            f.truncate(progress["archive_bytes"])
+        print(f"resuming {key.decode()} at entry {offset}")
+    elif os.path.exists(archive_path):
+        os.remove(archive_path)
+
+    while True:
+        entries = redis_client.lrange(key, offset, offset + CHUNK_SIZE - 1)
+        if not entries:
+            break
+        # every chunk is its own gzip member, gzip readers treat them as one stream
+        with gzip.open(archive_path, "ab") as f:
+            f.write(b"\n".join(entries) + b"\n")
+        offset += len(entries)
+        with open(progress_path + ".tmp", "w") as f:
+            json.dump({"offset": offset, "archive_bytes": os.path.getsize(archive_path)}, f)
+        os.replace(progress_path + ".tmp", progress_path)
+
+    return offset
+
 def cleanup_old_logs(days_to_keep=30):
     today = datetime.now().date()
     cutoff_date = today - timedelta(days=days_to_keep)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
 
-    print("before")
-    keys = redis_client.keys("checkbox_logs:*")
-    print("here")
+    total_entries = 0
+    total_freed = 0
+    started = time.time()
 
-    for key in keys:
-        key_date = datetime.strptime(key.decode().split(':')[1], '%Y-%m-%d').date()
-        if key_date < cutoff_date:
-            redis_client.delete(key)
-        else:
-            # Keys are sorted, so if we find a key that's not old enough, we can stop
+    for key_date, key in find_log_keys():
+        if key_date >= cutoff_date:
             break
 
+        key_started = time.time()
+        archive_path = os.path.join(ARCHIVE_DIR, f"checkbox_logs-{key_date}.txt.gz")
+        freed = redis_client.memory_usage(key) or 0
+        entries = archive_key(key, archive_path)
+
+        # UNLINK frees the list in a background thread instead of blocking like DEL
+        redis_client.unlink(key)
+        os.remove(archive_path + ".progress")
+
+        elapsed = max(time.time() - key_started, 1e-6)
+        total_entries += entries
+        total_freed += freed
+        print(f"archived {key.decode()}: {entries} entries in {elapsed:.1f}s "
+              f"({entries / elapsed:.0f} entries/s), {os.path.getsize(archive_path)} bytes on disk, "
+              f"~{freed} bytes freed")
+
+    elapsed = max(time.time() - started, 1e-6)
+    print(f"done: {total_entries} entries in {elapsed:.1f}s ({total_entries / elapsed:.0f} entries/s), "
+          f"~{total_freed} bytes freed")
+
 # Run this script daily
-cleanup_old_logs()
+if __name__ == "__main__":
+    cleanup_old_logs()
@@ -44,7 +44,7 @@ do
 
     ### Sync freeze bit script
     #echo "syncing freeze_bits_and_compute_stats.py"
-    #rsync $RSYNC_OPTS -e "ssh -i $SSH_KEY" "freeze_bits_and_compute_stats.py" "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR/"
+    #rsync $RSYNC_OPTS -e "ssh -i $SSH_KEY" freeze_bits_and_compute_stats.py bitset_snapshot.py "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR/"
 
     #### Sync compute-stats script
     #echo "syncing compute_stats.sh"
@@ -54,6 +54,10 @@ do
     #echo "Syncing server.py..."
     #rsync $RSYNC_OPTS -e "ssh -i $SSH_KEY" "$LOCAL_SERVER" "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR/"
 
+    ##Sync the modules server.py imports
+    #echo "Syncing server modules..."
+    #rsync $RSYNC_OPTS -e "ssh -i $SSH_KEY" toggle_codec.py checkbox_log.py metrics.py profiler.py shared_state.py bitset_snapshot.py history.py heavy_hitters.py static_assets.py "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR/"
+
     # ##Sync server.py
     # echo "Syncing server.py..."
     # rsync $RSYNC_OPTS -e "ssh -i $SSH_KEY" "$LOCAL_SERVER" "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR/"
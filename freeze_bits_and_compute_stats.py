@@ -3,7 +3,10 @@ from redis import ConnectionPool
 import time
 import json
 from collections import defaultdict
+from typing import NamedTuple
 import os
+from bitarray import bitarray
+from bitset_snapshot import read_snapshot
 
 testing = not all(os.environ.get(var) for var in ['REDIS_HOST', 'REDIS_PORT', 'REDIS_USERNAME', 'REDIS_PASSWORD'])
 
@@ -12,6 +15,8 @@ local frozen_bitset = KEYS[1]
 local frozen_count_key = KEYS[2]
 local index = tonumber(ARGV[1])
 
+-- frozen boxes never get toggled again, so nothing else would take them out of the time index
+redis.call('ZREM', KEYS[3], index)
 local was_already_frozen = redis.call('GETBIT', frozen_bitset, index)
 if was_already_frozen == 0 then
     redis.call('SETBIT', frozen_bitset, index, 1)
@@ -22,6 +27,56 @@ else
 end
 """
 
+# same as atomic_flip_script for every index in ARGV, returns the ones it froze
+atomic_flip_many_script = """
+local frozen_bitset = KEYS[1]
+local frozen_count_key = KEYS[2]
+local index_key = KEYS[3]
+local newly_frozen = {}
+
+for i = 1, #ARGV do
+    local index = tonumber(ARGV[i])
+    redis.call('ZREM', index_key, index)
+    if redis.call('GETBIT', frozen_bitset, index) == 0 then
+        redis.call('SETBIT', frozen_bitset, index, 1)
+        newly_frozen[#newly_frozen + 1] = index
+    end
+end
+
+if #newly_frozen > 0 then
+    redis.call('INCRBY', frozen_count_key, #newly_frozen)
+end
+return newly_frozen
+"""
+
+# pops every index in last_checked_by_time that was checked before the threshold
+# (up to a limit per call) and freezes it, returns {popped, newly_frozen}
+freeze_due_script = """
+local index_key = KEYS[1]
+local frozen_bitset = KEYS[2]
+local frozen_count_key = KEYS[3]
+local threshold = ARGV[1]
+local limit = tonumber(ARGV[2])
+
+local due = redis.call('ZRANGEBYSCORE', index_key, '-inf', '(' .. threshold, 'LIMIT', 0, limit)
+local newly_frozen = {}
+
+for _, index in ipairs(due) do
+    if redis.call('GETBIT', frozen_bitset, index) == 0 then
+        redis.call('SETBIT', frozen_bitset, index, 1)
+        newly_frozen[#newly_frozen + 1] = tonumber(index)
+    end
+end
+
+if #due > 0 then
+    redis.call('ZREM', index_key, unpack(due))
+end
+if #newly_frozen > 0 then
+    redis.call('INCRBY', frozen_count_key, #newly_frozen)
+end
+return {#due, newly_frozen}
+"""
+
 def get_redis_client():
     pool = None
     if testing:
@@ -104,7 +159,95 @@ def find_longest_streaks(bitstring):
                 longest_1_idx = current_1_idx
     return [[longest_0, longest_0_idx], [longest_1, longest_1_idx]]
 
-def freeze_bits(r, atomic_flip_hash):
+# The functions above walk a million character string one bit at a time. The ones
+# below work on the raw redis bytes with bitarray, which does the counting and
+# shifting in C, and give the same answers.
+
+class Streak(NamedTuple):
+    length: int
+    start: int
+
+class Region(NamedTuple):
+    region: int
+    count: int
+
+class BitsetStats(NamedTuple):
+    zeros: int
+    ones: int
+    longest_zeros: Streak
+    longest_ones: Streak
+    dense_zeros: list
+    dense_ones: list
+
+def bytes_to_bitarray(byte_string):
+    bits = bitarray(endian="big")
+    bits.frombytes(byte_string or b"")
+    return bits
+
+def longest_run(bits, bit_kind=1):
+    # runs[i] is set when bits[i:i + length] are all bit_kind. We double length while
+    # some run is still that long, then binary search the rest, so this takes
+    # O(log n) whole-bitarray operations instead of a python loop over every bit.
+    runs = bits.copy() if bit_kind else ~bits
+    if not runs.any():
+        return Streak(0, 0)
+
+    length = 1
+    while True:
+        longer = runs & (runs << length)
+        if not longer.any():
+            break
+        runs = longer
+        length *= 2
+
+    step = length // 2
+    while step:
+        longer = runs & (runs << step)
+        if longer.any():
+            runs = longer
+            length += step
+        step //= 2
+
+    # the first place a longest run fits is where it starts, same as find_longest_streaks
+    return Streak(length, runs.index(1))
+
+def region_counts(bits, bit_kind=1, region_size=10000):
+    counts = []
+    for start in range(0, len(bits), region_size):
+        ones = bits.count(1, start, start + region_size)
+        counts.append(ones if bit_kind else min(region_size, len(bits) - start) - ones)
+    return counts
+
+def dense_regions(bits, bit_kind=1, region_size=10000, top_n=3):
+    regions = [Region(region, count)
+               for region, count in enumerate(region_counts(bits, bit_kind, region_size)) if count > 0]
+    return sorted(regions, key=lambda x: x.count, reverse=True)[:top_n]
+
+def compute_bitset_stats(byte_string, region_size=10000, top_n=3):
+    bits = bytes_to_bitarray(byte_string)
+    ones = bits.count(1)
+    return BitsetStats(
+        zeros=len(bits) - ones,
+        ones=ones,
+        longest_zeros=longest_run(bits, 0),
+        longest_ones=longest_run(bits, 1),
+        dense_zeros=dense_regions(bits, 0, region_size, top_n),
+        dense_ones=dense_regions(bits, 1, region_size, top_n),
+    )
+
+def print_snapshot_stats(path):
+    # works straight off a server.py bitset snapshot, no redis needed
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        raise SystemExit(f"{path} isn't a usable snapshot")
+    stats = compute_bitset_stats(snapshot.raw)
+    print(f"snapshot from {snapshot.timestamp}: {stats.ones} checked, {stats.zeros} unchecked")
+    print(f"longest unchecked run {' : '.join(map(str, stats.longest_zeros))}, "
+          f"longest checked run {' : '.join(map(str, stats.longest_ones))}")
+    print(f"densest checked {format_dense_regions(stats.dense_ones)}")
+    print(f"densest unchecked {format_dense_regions(stats.dense_zeros)}")
+
+def freeze_bits(r, atomic_flip_hash, atomic_flip_many_hash=None):
     current_time = get_time(r)
     freeze_time = get_freeze_time(r)
     safety_buffer = freeze_time * 0.1
@@ -123,6 +266,10 @@ def freeze_bits(r, atomic_flip_hash):
         if cursor == -1: cursor = 0
         cursor, chunk = r.hscan("last_checked", cursor, count=chunk_size)
 
+        if atomic_flip_many_hash is not None:
+            freeze_chunk(r, atomic_flip_many_hash, chunk, threshold, stats)
+            continue
+
         for index, last_checked in chunk.items():
             index = int(index.decode("utf-8"))
             last_checked = int(last_checked.decode("utf-8"))
@@ -131,7 +278,7 @@ def freeze_bits(r, atomic_flip_hash):
             if last_checked != 0 and last_checked < threshold:
                 stats["eligible_for_freezing"] += 1
 
-                did_freeze = r.evalsha(atomic_flip_hash, 2, "frozen_bitset", "frozen_count", index)
+                did_freeze = r.evalsha(atomic_flip_hash, 3, "frozen_bitset", "frozen_count", "last_checked_by_time", index)
 
                 if did_freeze == 1:
                     stats["newly_frozen"] += 1
@@ -143,23 +290,111 @@ def freeze_bits(r, atomic_flip_hash):
     stats["freeze_time_ms"] = freeze_time
     return stats
 
+def freeze_due(r, freeze_due_hash, chunk_size=5000):
+    # only touches boxes whose deadline has passed, so it's cheap enough to run every few seconds
+    current_time = get_time(r)
+    freeze_time = get_freeze_time(r)
+    safety_buffer = freeze_time * 0.1
+    threshold = current_time - freeze_time - safety_buffer
+
+    stats = {
+        "total_checked": 0,
+        "eligible_for_freezing": 0,
+        "newly_frozen": 0,
+        "already_frozen": 0
+    }
+
+    while True:
+        popped, newly_frozen = r.evalsha(
+            freeze_due_hash, 3, "last_checked_by_time", "frozen_bitset", "frozen_count",
+            threshold, chunk_size)
+        stats["total_checked"] += popped
+        stats["eligible_for_freezing"] += popped
+        stats["newly_frozen"] += len(newly_frozen)
+        stats["already_frozen"] += popped - len(newly_frozen)
+        if newly_frozen:
+            r.publish("frozen_bit_channel", json.dumps(newly_frozen))
+        if popped < chunk_size:
+            break
+
+    # a full scan sees every frozen box, this only sees the ones due now, so read the total
+    stats["frozen_count"] = int(r.get("frozen_count") or 0)
+    stats["freeze_time_ms"] = freeze_time
+    return stats
+
+def backfill_time_index(r, chunk_size=5000):
+    # copies the checked entries of last_checked into last_checked_by_time, only needed
+    # once for boxes that were checked before the index existed
+    cursor = -1
+    added = 0
+    while cursor != 0:
+        if cursor == -1: cursor = 0
+        cursor, chunk = r.hscan("last_checked", cursor, count=chunk_size)
+        mapping = {index: int(last_checked) for index, last_checked in chunk.items() if int(last_checked) != 0}
+        if mapping:
+            added += r.zadd("last_checked_by_time", mapping)
+    return added
+
+def freeze_chunk(r, atomic_flip_many_hash, chunk, threshold, stats):
+    # one script call and one publish for the whole HSCAN chunk
+    eligible = []
+    for index, last_checked in chunk.items():
+        last_checked = int(last_checked.decode("utf-8"))
+        stats["total_checked"] += 1
+        if last_checked != 0 and last_checked < threshold:
+            eligible.append(int(index.decode("utf-8")))
+
+    if not eligible:
+        return
+
+    newly_frozen = r.evalsha(atomic_flip_many_hash, 3, "frozen_bitset", "frozen_count", "last_checked_by_time", *eligible)
+    stats["eligible_for_freezing"] += len(eligible)
+    stats["newly_frozen"] += len(newly_frozen)
+    stats["already_frozen"] += len(eligible) - len(newly_frozen)
+    if newly_frozen:
+        r.publish("frozen_bit_channel", json.dumps(newly_frozen))
+
 if __name__ == "__main__":
+    # STATS_SNAPSHOT=state/bitset.snapshot only prints stats for that file and doesn't touch redis
+    if os.environ.get("STATS_SNAPSHOT"):
+        print_snapshot_stats(os.environ["STATS_SNAPSHOT"])
+        raise SystemExit
+
     r = get_redis_client()
-    atomic_flip_hash = r.script_load(atomic_flip_script)
-    stats = freeze_bits(r, atomic_flip_hash)
-    sunset_bitset = bytes_to_bits(r.get("sunset_bitset"))
-    sunset_streaks = find_longest_streaks(sunset_bitset)
+    # FREEZE_MODE=due pops due boxes off last_checked_by_time instead of scanning all of last_checked
+    freeze_mode = os.environ.get("FREEZE_MODE", "scan")
+    if os.environ.get("FREEZE_BACKFILL", "false").lower() == "true":
+        print(f"backfilled {backfill_time_index(r)} entries into last_checked_by_time")
+
+    loop_seconds = float(os.environ.get("FREEZE_LOOP_SECONDS", "0"))
+    if loop_seconds > 0:
+        # just keep freezing, the stats page is still built by the cron run
+        freeze_due_hash = r.script_load(freeze_due_script)
+        while True:
+            print(freeze_due(r, freeze_due_hash))
+            time.sleep(loop_seconds)
+
+    if freeze_mode == "due":
+        stats = freeze_due(r, r.script_load(freeze_due_script))
+    else:
+        atomic_flip_hash = r.script_load(atomic_flip_script)
+        atomic_flip_many_hash = None
+        if os.environ.get("FREEZE_BATCH", "true").lower() == "true":
+            atomic_flip_many_hash = r.script_load(atomic_flip_many_script)
+        stats = freeze_bits(r, atomic_flip_hash, atomic_flip_many_hash)
+    sunset_stats = compute_bitset_stats(r.get("sunset_bitset"))
+    sunset_streaks = [sunset_stats.longest_zeros, sunset_stats.longest_ones]
 
-    frozen_bitset = bytes_to_bits(r.get("frozen_bitset"))
-    frozen_streaks = find_longest_streaks(frozen_bitset)
+    frozen_stats = compute_bitset_stats(r.get("frozen_bitset"))
+    frozen_streaks = [frozen_stats.longest_zeros, frozen_stats.longest_ones]
     
     f = format_dense_regions
-    dense_frozen_1s = f(find_dense_regions(frozen_bitset, bit_kind="1"))
-    dense_frozen_0s = f(find_dense_regions(frozen_bitset, bit_kind="0"))
-    dense_unchecked = f(find_dense_regions(sunset_bitset, bit_kind="0"))
-    dense_checked = f(find_dense_regions(sunset_bitset, bit_kind="1"))
-    print("0" in sunset_bitset)
-    print(len(list(x for x in sunset_bitset if x == "0")))
+    dense_frozen_1s = f(frozen_stats.dense_ones)
+    dense_frozen_0s = f(frozen_stats.dense_zeros)
+    dense_unchecked = f(sunset_stats.dense_zeros)
+    dense_checked = f(sunset_stats.dense_ones)
+    print(sunset_stats.zeros > 0)
+    print(sunset_stats.zeros)
     print(r.get("sunset_count"))
 
     html_content = f"""
@@ -0,0 +1,177 @@
+import hashlib
+import ipaddress
+import json
+import struct
+import time
+import zlib
+from array import array
+from operator import add
+
+# Finds the sources clicking the most boxes, in fixed memory and a handful of operations
+# per toggle however many addresses show up.
+#
+# Every toggle goes into a count-min sketch: `depth` rows of `width` counters, each row
+# with its own hash of the source. A source's count is the smallest of its counters,
+# which can only overestimate, and only by what the sources it collides with clicked.
+# Counts are kept per window of `window_seconds` (aligned to the clock, so every worker
+# agrees where windows start), and a rate is this window plus the part of the previous
+# window that is still within the last `window_seconds`.
+#
+# The heaviest sources seen are kept as candidates, so there's something to list: a new
+# source only gets in once its count beats the smallest candidate's.
+#
+# Workers swap summaries (both windows of counters plus their candidates) every so often
+# and fold everyone else's into their own, so rates are for the whole site rather than
+# this worker, just a merge interval behind. Hashes are keyed blake2b rather than hash(),
+# which is salted per process, so counters line up between workers.
+
+SUMMARY_MAGIC = b"CBHH"
+SUMMARY_VERSION = 1
+# magic | version (uint16) | window (uint64) | width (uint32) | depth (uint32) | length of the candidates (uint32)
+SUMMARY_HEADER = struct.Struct("<4sHQIII")
+HASH_KEY = b"one-million-checkboxes"
+
+def source_key(forwarded_for, ipv6_prefix=64, trusted_proxies=1):
+    # the client as our outermost trusted proxy saw it. Each proxy appends the address it
+    # got the request from, so that's `trusted_proxies` from the right; anything further
+    # left came from the client and can be anything. IPv6 is grouped by prefix, since
+    # anyone with one address in a /64 usually has all of them
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()] or [""]
+    address = hops[max(len(hops) - trusted_proxies, 0)]
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address[:64]
+    if ip.version == 6:
+        if ip.ipv4_mapped is not None:
+            return str(ip.ipv4_mapped)
+        return str(ipaddress.ip_network(f"{ip}/{ipv6_prefix}", strict=False))
+    return str(ip)
+
+class HeavyHitters:
+    def __init__(self, width=2048, depth=4, top=32, window_seconds=10):
+        self.width = width
+        self.depth = depth
+        self.top_size = top
+        self.window_seconds = window_seconds
+        self.empty = array("I", bytes(4 * width * depth))
+        self.window = None
+        self.current = self.empty
+        self.previous = self.empty
+        # everyone else's counts as of the last merge, and which window those were for
+        self.remote_window = None
+        self.remote_current = self.empty
+        self.remote_previous = self.empty
+        self.remote_candidates = set()
+        # source -> rate when it was last seen
+        self.candidates = {}
+        self.floor = 0
+
+    def columns(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8, key=HASH_KEY).digest()
+        h1, h2 = struct.unpack("<II", digest)
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def roll(self, now):
+        window = int(now // self.window_seconds)
+        if window == self.window:
+            return
+        self.previous = self.current if self.window == window - 1 else self.empty
+        self.current = array("I", self.empty)
+        self.window = window
+        # candidates' rates have gone stale, re-rate them so the floor means something again
+        rates = {key: self.rate_at(self.columns(key), now) for key in self.candidates}
+        self.candidates = {key: rate for key, rate in rates.items() if rate > 0}
+        self.floor = min(self.candidates.values(), default=0)
+
+    def remote_counts(self):
+        if self.remote_window == self.window:
+            return self.remote_current, self.remote_previous
+        if self.remote_window == self.window - 1:
+            return self.empty, self.remote_current
+        return self.empty, self.empty
+
+    def rate_at(self, columns, now):
+        # toggles per second over the last window_seconds
+        remaining = self.window + 1 - now / self.window_seconds
+        remote_current, remote_previous = self.remote_counts()
+        count = min(self.current[column] + remote_current[column]
+                    + (self.previous[column] + remote_previous[column]) * remaining
+                    for column in columns)
+        return count / self.window_seconds
+
+    def observe(self, key, now=None):
+        # counts one toggle from key and returns its rate
+        now = time.time() if now is None else now
+        self.roll(now)
+        columns = self.columns(key)
+        for column in columns:
+            self.current[column] += 1
+        rate = self.rate_at(columns, now)
+        self.track(key, rate)
+        return rate
+
+    def rate(self, key, now=None):
+        now = time.time() if now is None else now
+        self.roll(now)
+        return self.rate_at(self.columns(key), now)
+
+    def track(self, key, rate):
+        if key in self.candidates or len(self.candidates) < self.top_size:
+            self.candidates[key] = rate
+            return
+        if rate <= self.floor:
+            return
+        # only scans the candidates when a source outgrows the smallest of them
+        del self.candidates[min(self.candidates, key=self.candidates.get)]
+        self.candidates[key] = rate
+        self.floor = min(self.candidates.values())
+
+    def top(self, now=None):
+        # [(rate, source)] for the heaviest sources this worker or any other has seen, heaviest first
+        now = time.time() if now is None else now
+        self.roll(now)
+        rates = [(self.rate_at(self.columns(key), now), key) for key in set(self.candidates) | self.remote_candidates]
+        return sorted((entry for entry in rates if entry[0] > 0), reverse=True)[:self.top_size]
+
+    def summary(self, now=None):
+        self.roll(time.time() if now is None else now)
+        candidates = json.dumps(sorted(self.candidates)).encode("utf-8")
+        header = SUMMARY_HEADER.pack(SUMMARY_MAGIC, SUMMARY_VERSION, self.window,
+                                     self.width, self.depth, len(candidates))
+        return header + candidates + zlib.compress(self.current.tobytes() + self.previous.tobytes(), 1)
+
+    def merge(self, summaries, now=None):
+        # replaces what we know about other workers with their latest summaries, not ours
+        self.roll(time.time() if now is None else now)
+        current = array("I", self.empty)
+        previous = array("I", self.empty)
+        candidates = set()
+        for summary in summaries:
+            try:
+                magic, version, window, width, depth, length = SUMMARY_HEADER.unpack_from(summary, 0)
+                if magic != SUMMARY_MAGIC or version != SUMMARY_VERSION or (width, depth) != (self.width, self.depth):
+                    continue
+                start = SUMMARY_HEADER.size
+                counts = array("I")
+                counts.frombytes(zlib.decompress(summary[start + length:]))
+                keys = json.loads(summary[start:start + length])
+            except (struct.error, zlib.error, ValueError) as e:
+                print(f"Skipping heavy hitter summary: {e}")
+                continue
+            size = len(self.empty)
+            if len(counts) != 2 * size:
+                continue
+            if window == self.window:
+                current = array("I", map(add, current, counts[:size]))
+                previous = array("I", map(add, previous, counts[size:]))
+            elif window == self.window - 1:
+                previous = array("I", map(add, previous, counts[:size]))
+            else:
+                # that worker has stopped summarizing, or its clock is off
+                continue
+            candidates.update(keys)
+        self.remote_window = self.window
+        self.remote_current = current
+        self.remote_previous = previous
+        self.remote_candidates = candidates
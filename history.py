@@ -0,0 +1,297 @@
+import argparse
+import fcntl
+import json
+import os
+import re
+import struct
+import time
+import zlib
+from datetime import datetime
+
+from bitarray import bitarray
+from bitarray.util import zeros
+
+from bitset_snapshot import read_snapshot
+from checkbox_log import block_size, day_for, hour_for, iter_blocks, iter_hour_index, log_files
+
+# Point-in-time views of the bitset, built from the checkbox log (see checkbox_log.py).
+#
+# Every so often a keyframe of the whole bitset is written next to that day's logs:
+#
+#   <dir>/<YYYY-MM-DD>/keyframes/<timestamp ms>.kf
+#
+#   magic "CBKF" | version (uint16) | timestamp ms (uint64) | size in bits (uint32)
+#   crc32 of the bitset (uint32) | length of the offsets (uint32)
+#   offsets, JSON {"<day>/<writer>.log": byte offset}
+#   the bitset, zlib compressed, big-endian bits like redis
+#
+# A keyframe is the whole grid as of its timestamp. The offsets say where in each log file
+# to start reading for toggles stamped after it. So the state at any time t is the newest
+# keyframe at or before t, plus the toggles stamped after it and up to t, read from those
+# offsets. That costs at most one keyframe interval of log, however long the day has been.
+#
+# The log in a directory only has the toggles of the hosts writing to it, and only since
+# file logging started, so keyframes can't come from replaying it from nothing. They're
+# copies of the live bitset instead: server.py writes one every KEYFRAME_SECONDS, and
+# `python history.py <dir> seed --snapshot state/bitset.snapshot` makes one from a
+# bitset_snapshot.py snapshot. Between keyframes, lookups replay whatever logs are in the
+# directory, which is every toggle if the hosts' logs are collected in one place and only
+# this host's otherwise. `build` fills in keyframes between existing ones from the log,
+# for such a collected directory; it's slow, pure python, so run it out of process.
+
+KEYFRAME_MAGIC = b"CBKF"
+KEYFRAME_VERSION = 1
+KEYFRAME_HEADER = struct.Struct("<4sHQIII")
+DAY_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+class Keyframe:
+    def __init__(self, timestamp, bits, offsets):
+        self.timestamp = timestamp
+        self.bits = bits
+        self.offsets = offsets
+
+def keyframe_directory(directory, day):
+    return os.path.join(directory, day, "keyframes")
+
+def write_keyframe(directory, keyframe):
+    path = os.path.join(keyframe_directory(directory, day_for(keyframe.timestamp)), f"{keyframe.timestamp}.kf")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    raw = keyframe.bits.tobytes()
+    offsets = json.dumps(keyframe.offsets, sort_keys=True).encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(KEYFRAME_HEADER.pack(KEYFRAME_MAGIC, KEYFRAME_VERSION, keyframe.timestamp,
+                                     len(keyframe.bits), zlib.crc32(raw), len(offsets)))
+        f.write(offsets)
+        f.write(zlib.compress(raw, 6))
+    os.replace(tmp_path, path)
+    return path
+
+def read_keyframe(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, timestamp, size, crc, offsets_length = KEYFRAME_HEADER.unpack_from(data, 0)
+    if magic != KEYFRAME_MAGIC or version != KEYFRAME_VERSION:
+        raise ValueError(f"{path} isn't a version {KEYFRAME_VERSION} keyframe")
+    start = KEYFRAME_HEADER.size
+    offsets = json.loads(data[start:start + offsets_length])
+    raw = zlib.decompress(data[start + offsets_length:])
+    if zlib.crc32(raw) != crc:
+        raise ValueError(f"{path} doesn't match its checksum")
+    bits = bitarray(endian="big")
+    bits.frombytes(raw)
+    del bits[size:]
+    return Keyframe(timestamp, bits, offsets)
+
+def log_days(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if DAY_PATTERN.match(name))
+
+def keyframe_timestamps(directory, day):
+    path = keyframe_directory(directory, day)
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(name[:-len(".kf")]) for name in os.listdir(path) if name.endswith(".kf"))
+
+def find_keyframe(directory, timestamp):
+    # the newest readable keyframe at or before timestamp, or None
+    for day in reversed([day for day in log_days(directory) if day <= day_for(timestamp)]):
+        for keyframe_timestamp in reversed(keyframe_timestamps(directory, day)):
+            if keyframe_timestamp > timestamp:
+                continue
+            try:
+                return read_keyframe(os.path.join(keyframe_directory(directory, day), f"{keyframe_timestamp}.kf"))
+            except (OSError, ValueError, zlib.error) as e:
+                print(f"Skipping keyframe: {e}")
+    return None
+
+# blocks are a flush's worth of toggles, so none starting this much before a time has any after it
+BLOCK_SPAN_MS = 60_000
+
+def safe_offsets(directory, timestamp):
+    # for each of the day's log files, a block boundary no later than the first block with
+    # toggles stamped after timestamp. Taken from the hour index, so it's never partway into a
+    # block another process is still writing, at the cost of replaying up to an hour of log
+    offsets = {}
+    start = timestamp - BLOCK_SPAN_MS
+    if day_for(start) != day_for(timestamp):
+        return offsets
+    for path in log_files(directory, day_for(timestamp)):
+        index_path = path[:-len(".log")] + ".idx"
+        if not os.path.exists(index_path):
+            continue
+        earlier = [offset for hour, offset in iter_hour_index(index_path) if hour <= hour_for(start)]
+        if earlier:
+            offsets[os.path.relpath(path, directory)] = max(earlier)
+    return offsets
+
+def live_keyframe(directory, raw, size, timestamp):
+    # a keyframe from the real bitset, which has to include every toggle stamped up to timestamp.
+    # Toggles stamped after it may be in there too, replaying them again is harmless
+    bits = bitarray(endian="big")
+    bits.frombytes(raw)
+    if len(bits) < size:
+        bits.extend(zeros(size - len(bits), endian="big"))
+    del bits[size:]
+    return Keyframe(timestamp, bits, safe_offsets(directory, timestamp))
+
+def lock_keyframes(directory):
+    # several workers share a log directory, only the one holding this writes keyframes
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, "keyframes.lock"), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class LogCursor:
+    # reads every writer's log forward from a point in time, remembering how far it got in each file
+    def __init__(self, directory, timestamp=0, offsets=None):
+        self.directory = directory
+        self.timestamp = timestamp
+        self.offsets = dict(offsets or {})
+
+    def advance(self, until):
+        # (timestamp, index, state) for every toggle after the cursor and up to until, in timestamp order
+        entries = []
+        first_day = day_for(self.timestamp)
+        last_day = day_for(until)
+        for day in log_days(self.directory):
+            if day < first_day or day > last_day:
+                continue
+            for path in log_files(self.directory, day):
+                name = os.path.relpath(path, self.directory)
+                offset = self.offsets.get(name, 0)
+                for block_offset, base_ts, deltas, _, indices, states in iter_blocks(path, offset):
+                    if base_ts > until:
+                        break
+                    for delta, index, state in zip(deltas, indices, states):
+                        if self.timestamp < base_ts + delta <= until:
+                            entries.append((base_ts + delta, index, state))
+                    if base_ts + max(deltas, default=0) > until:
+                        break
+                    offset = block_offset + block_size(len(indices))
+                self.offsets[name] = offset
+
+        # files from days before `until` will never be read again
+        self.offsets = {name: offset for name, offset in self.offsets.items() if name[:10] >= last_day}
+        self.timestamp = until
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+def apply_entries(bits, entries):
+    for _, index, state in entries:
+        if index < len(bits):
+            bits[index] = state
+
+class History:
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+
+    def start_at(self, timestamp):
+        # (bitset, cursor) as of the newest keyframe at or before timestamp
+        keyframe = find_keyframe(self.directory, timestamp)
+        if keyframe is None:
+            raise ValueError(f"no keyframe in {self.directory} at or before {timestamp}, the log alone can't say")
+        bits = keyframe.bits
+        if len(bits) < self.size:
+            bits.extend(zeros(self.size - len(bits), endian="big"))
+        return bits, LogCursor(self.directory, keyframe.timestamp, keyframe.offsets)
+
+    def at(self, timestamp):
+        bits, cursor = self.start_at(timestamp)
+        apply_entries(bits, cursor.advance(timestamp))
+        return bits
+
+    def replay(self, start, end, step_ms):
+        # yields (timestamp, bitset) every step_ms of log time from start to end. The same
+        # bitarray is updated in place between frames, copy it if you want to keep one.
+        bits, cursor = self.start_at(start)
+        apply_entries(bits, cursor.advance(start))
+        yield start, bits
+        timestamp = start
+        while timestamp < end:
+            timestamp = min(timestamp + step_ms, end)
+            apply_entries(bits, cursor.advance(timestamp))
+            yield timestamp, bits
+
+class KeyframeBuilder:
+    # writes keyframes every interval from the log, picking up from the newest one on disk.
+    # Only as right as the log in the directory, see the top of this file
+    def __init__(self, directory, size, interval_seconds):
+        self.directory = directory
+        self.size = size
+        self.interval = int(interval_seconds * 1000)
+        self.bits = None
+        self.cursor = None
+
+    def build(self, until, max_keyframes=None):
+        # writes keyframes up to until, every log flush before then has to have happened already
+        if self.cursor is None:
+            if find_keyframe(self.directory, until) is None:
+                # nothing to start from, it takes a live keyframe first
+                return 0
+            self.bits, self.cursor = History(self.directory, self.size).start_at(until)
+
+        start = self.cursor.timestamp
+        written = 0
+        boundary = (start // self.interval + 1) * self.interval
+        while boundary <= until and (max_keyframes is None or written < max_keyframes):
+            entries = self.cursor.advance(boundary)
+            if entries:
+                apply_entries(self.bits, entries)
+                write_keyframe(self.directory, Keyframe(boundary, self.bits, self.cursor.offsets))
+                written += 1
+            boundary += self.interval
+        return written
+
+def parse_time(value):
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="keyframes and point-in-time views of the checkbox log")
+    parser.add_argument("directory", help="CHECKBOX_LOG_DIR")
+    parser.add_argument("--size", type=int, default=1_000_000)
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed = commands.add_parser("seed", help="write a keyframe from a bitset_snapshot.py snapshot")
+    seed.add_argument("--snapshot", required=True)
+    build = commands.add_parser("build", help="write keyframes between the newest one and now from the log")
+    build.add_argument("--interval", type=float, default=300, help="seconds between keyframes")
+    build.add_argument("--lag", type=float, default=60, help="leave the last this many seconds alone")
+    at = commands.add_parser("at", help="the bitset at a time, ms or ISO 8601")
+    at.add_argument("time")
+    at.add_argument("--out", help="write the raw bitset here")
+    timelapse = commands.add_parser("timelapse", help="checked count every step between two times")
+    timelapse.add_argument("start")
+    timelapse.add_argument("end")
+    timelapse.add_argument("--step", type=float, default=60, help="seconds between frames")
+    args = parser.parse_args()
+
+    started = time.time()
+    if args.command == "seed":
+        snapshot = read_snapshot(args.snapshot)
+        if snapshot is None:
+            raise SystemExit(f"{args.snapshot} isn't a usable snapshot")
+        print(f"wrote {write_keyframe(args.directory, live_keyframe(args.directory, snapshot.raw, args.size, snapshot.timestamp))}")
+    elif args.command == "build":
+        if lock_keyframes(args.directory) is None:
+            raise SystemExit(f"something else is writing keyframes in {args.directory}")
+        builder = KeyframeBuilder(args.directory, args.size, args.interval)
+        print(f"wrote {builder.build(int((time.time() - args.lag) * 1000))} keyframes")
+    elif args.command == "at":
+        bits = History(args.directory, args.size).at(parse_time(args.time))
+        print(f"{bits.count()} checked")
+        if args.out:
+            with open(args.out, "wb") as f:
+                f.write(bits.tobytes())
+    else:
+        history = History(args.directory, args.size)
+        for timestamp, bits in history.replay(parse_time(args.start), parse_time(args.end), int(args.step * 1000)):
+            print(f"{datetime.fromtimestamp(timestamp / 1000).isoformat()} {bits.count()}")
+    print(f"took {time.time() - started:.2f}s")
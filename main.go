@@ -573,7 +573,6 @@ func main() {
 			messages := subscriber.Channel()
 			changed := make(map[int]bool, maxBatchSize)
 			maxTs := 0
-			tmp := make([]int, 3)
 
 			emitAll := func() {
 				on := make([]int, 0, len(changed)/2)
@@ -593,9 +592,31 @@ func main() {
 			for {
 				select {
 				case msg := <-messages:
-					json.Unmarshal([]byte(msg.Payload), &tmp)
-					index, nbv, ts := tmp[0], tmp[1], tmp[2]
-					changed[index] = nbv > 0
+					// either [index, value, ts] or, from python workers with BATCH_TOGGLES on,
+					// [[on...], [off...], ts]. Binary messages (BINARY_PUBSUB) aren't JSON and get skipped
+					var update []json.RawMessage
+					if err := json.Unmarshal([]byte(msg.Payload), &update); err != nil || len(update) != 3 {
+						log.Error("Skipping toggle message", "err", err)
+						continue
+					}
+					var ts int
+					json.Unmarshal(update[2], &ts)
+					if len(update[0]) > 0 && update[0][0] == '[' {
+						var on, off []int
+						json.Unmarshal(update[0], &on)
+						json.Unmarshal(update[1], &off)
+						for _, index := range on {
+							changed[index] = true
+						}
+						for _, index := range off {
+							changed[index] = false
+						}
+					} else {
+						var index, nbv int
+						json.Unmarshal(update[0], &index)
+						json.Unmarshal(update[1], &nbv)
+						changed[index] = nbv > 0
+					}
 					maxTs = max(ts, maxTs)
 					if len(changed) < maxBatchSize {
 						continue
@@ -624,7 +645,7 @@ func main() {
 
 			messages := subscriber.Channel()
 			frozen := make([]int, 0, maxBatchSize)
-			tmp := make([]int, 1)
+			tmp := make([]int, 0, maxBatchSize)
 			emitAll := func() {
 				ws.Except().Emit("batched_frozen_bits", frozen)
 				log.Debug("emmitting", "frozen", frozen)
@@ -633,9 +654,10 @@ func main() {
 			for {
 				select {
 				case msg := <-messages:
+					// the freeze job publishes every index it froze in one message
+					tmp = tmp[:0]
 					json.Unmarshal([]byte(msg.Payload), &tmp)
-					index := tmp[0]
-					frozen = append(frozen, index)
+					frozen = append(frozen, tmp...)
 					if len(frozen) < maxBatchSize {
 						continue
 					}
@@ -857,14 +879,18 @@ if new_bit == 0 then
         -- Box is frozen, update frozen bitset and count
         redis.call('setbit', frozen_bitset_key, index, 1)
         redis.call('incr', frozen_count_key)
+        redis.call('zrem', 'last_checked_by_time', index)
         return {1, 0, 1}  -- Return 1 (checked), 0 for no change, and 1 to indicate newly frozen
     else
         -- Set the sentinel value instead of deleting
         redis.call('hset', 'last_checked', index, UNCHECKED_SENTINEL)
+        redis.call('zrem', 'last_checked_by_time', index)
     end
 else
     -- We're checking the box, update last_checked time
     redis.call('hset', 'last_checked', index, current_time)
+    -- and keep a time-ordered copy so the freeze job only looks at boxes that are due
+    redis.call('zadd', 'last_checked_by_time', current_time, index)
 end
 
 -- Proceed with the change
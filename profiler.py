@@ -0,0 +1,57 @@
+import os
+import signal
+import time
+from collections import Counter
+
+# A SIGPROF sampling profiler. Every `interval` seconds of CPU time the kernel interrupts
+# the process and we record whatever stack is running at that moment, which under
+# eventlet is whichever green thread holds the CPU. Idle time waiting on sockets is
+# never sampled, so this shows where the CPU goes and nothing else.
+#
+# Output is in the collapsed "frame;frame;frame count" format that flamegraph.pl and
+# speedscope read directly.
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.running = False
+        self.started_at = None
+        self.previous_handler = None
+
+    def start(self):
+        if self.running:
+            return False
+        self.samples = Counter()
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        self.started_at = time.time()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return self.collapsed()
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+        self.running = False
+        return self.collapsed()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def write(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{name}-{int(self.started_at or time.time())}.folded')
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+        return path
@@ -1,24 +1,52 @@
 import eventlet
-eventlet.monkey_patch(thread=True, time=True)
+# sockets have to be green too, the pub/sub consumer blocks on its socket in a green thread
+eventlet.monkey_patch(thread=True, time=True, socket=True, select=True)
+from eventlet import tpool
 
-from flask import Flask, render_template, jsonify, request, send_from_directory, send_file
-from flask_socketio import SocketIO
+from flask import Flask, render_template, jsonify, request, send_file, Response
+from flask_socketio import SocketIO, join_room, leave_room
 from flask_cors import CORS
 import os
+import hmac
+import signal
+import socket
+import tempfile
+import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 from bitarray import bitarray
+from bitarray.util import zeros
 import base64
+import gzip
 import json
+import threading
 import time
+import zlib
+from bisect import bisect_right
+from collections import deque
 from datetime import datetime
 from contextlib import contextmanager
+from toggle_codec import encode_toggles, decode_toggles, is_binary
+from checkbox_log import CheckboxLogWriter
+from history import live_keyframe, lock_keyframes, write_keyframe
+from profiler import SamplingProfiler
+from shared_state import DROPPED_NOTICE, SharedBitset, WorkerFanout
+from bitset_snapshot import BitsetPersistence
+from heavy_hitters import HeavyHitters, source_key
+from static_assets import StaticManifest
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 MAX_LOGS_PER_DAY = 400_000_000
 TOTAL_CHECKBOXES = 1_000_000
+# boxes per chunk for viewport loading, has to be a multiple of 8 so chunks are whole bytes
+CHUNK_SIZE = 8000
+TOTAL_CHUNKS = (TOTAL_CHECKBOXES + CHUNK_SIZE - 1) // CHUNK_SIZE
 REACT_BUILD_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), 'dist'))
-# I found this by portscanning my own VPC because the DNS record wouldn't work lmfao
-REDIS_REPLICA_IP="10.108.0.13"
 
 app = Flask(__name__, static_folder=REACT_BUILD_DIRECTORY)
 CORS(app)
@@ -27,78 +55,472 @@ scheduler = BackgroundScheduler()
 
 # Configuration
 USE_REDIS = os.environ.get('USE_REDIS', 'false').lower() == 'true'
+REDIS_SSL = os.environ.get('REDIS_SSL', 'true').lower() == 'true'
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '425'))
+# how long a command waits for a free pooled connection before giving up
+REDIS_POOL_TIMEOUT_SECONDS = float(os.environ.get('REDIS_POOL_TIMEOUT_SECONDS', '5'))
+REDIS_HEALTH_CHECK_SECONDS = int(os.environ.get('REDIS_HEALTH_CHECK_SECONDS', '10'))
+# REDIS_SHARDS=host[:port][/replica[:port]...],... splits the boxes into that many equal ranges,
+# each with its own bitset, count, scripts and pub/sub channel on its own redis. Unset keeps
+# everything in truncated_bitset and count on REDIS_HOST, which is what main.go expects.
+REDIS_SHARDS = os.environ.get('REDIS_SHARDS', '')
+# without LOCAL_MIRROR the total count is summed from the shards at most this often
+SHARD_COUNT_CACHE_SECONDS = float(os.environ.get('SHARD_COUNT_CACHE_SECONDS', '1'))
+# a changed bitset is rebuilt at most this often, and never served older than the max age
+SNAPSHOT_MIN_REBUILD_SECONDS = float(os.environ.get('SNAPSHOT_MIN_REBUILD_SECONDS', '0.5'))
+SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get('SNAPSHOT_MAX_AGE_SECONDS', '30'))
+# keep a copy of the bitset in every worker so reads never touch the replica
+LOCAL_MIRROR = os.environ.get('LOCAL_MIRROR', 'true').lower() == 'true'
+MIRROR_RESYNC_SECONDS = int(os.environ.get('MIRROR_RESYNC_SECONDS', '30'))
+# collect toggles for a few ms and apply them with one script call, one log push and one publish.
+# The publish is a [[on...], [off...], ts] batch, so main.go has to be new enough to read those
+BATCH_TOGGLES = os.environ.get('BATCH_TOGGLES', 'false').lower() == 'true'
+TOGGLE_BATCH_INTERVAL_MS = int(os.environ.get('TOGGLE_BATCH_INTERVAL_MS', '5'))
+TOGGLE_BATCH_MAX = int(os.environ.get('TOGGLE_BATCH_MAX', '500'))
+# how many chunks one client can subscribe to at once, past that it's cheaper to take every toggle
+MAX_CHUNK_SUBSCRIPTIONS = int(os.environ.get('MAX_CHUNK_SUBSCRIPTIONS', '16'))
+# how many recent batched_bit_toggles batches we keep around for /api/changes
+CHANGE_RING_SIZE = int(os.environ.get('CHANGE_RING_SIZE', '3000'))
+# batches can arrive a bit out of timestamp order across workers, so we re-send a little extra
+CHANGE_LAG_MARGIN_MS = int(os.environ.get('CHANGE_LAG_MARGIN_MS', '2000'))
+# 0 turns the periodic full_state broadcast off once clients catch up through /api/changes
+FULL_STATE_INTERVAL_SECONDS = int(os.environ.get('FULL_STATE_INTERVAL_SECONDS', '45'))
+# clients are hashed into this many buckets, each resynced at its own offset within the interval
+FULL_STATE_BUCKETS = int(os.environ.get('FULL_STATE_BUCKETS', '9'))
+# publish toggles on bit_toggle_channel in the toggle_codec format instead of JSON,
+# every worker reading the channel has to understand it before this is turned on
+BINARY_PUBSUB = os.environ.get('BINARY_PUBSUB', 'false').lower() == 'true'
+# the pub/sub consumer sends a batch out once it has this many messages or its oldest is this old,
+# and gives up on deltas for a full resync once its oldest has waited here longer than the max lag
+PUBSUB_FLUSH_SIZE = int(os.environ.get('PUBSUB_FLUSH_SIZE', '600'))
+PUBSUB_FLUSH_MS = int(os.environ.get('PUBSUB_FLUSH_MS', '50'))
+PUBSUB_MAX_LAG_MS = int(os.environ.get('PUBSUB_MAX_LAG_MS', '10000'))
+# 'file' buffers the toggle log in process and appends it to CHECKBOX_LOG_DIR in batches,
+# 'redis' keeps the old RPUSH onto checkbox_logs:<date> in the click path
+LOG_SINK = os.environ.get('LOG_SINK', 'file')
+CHECKBOX_LOG_DIR = os.environ.get('CHECKBOX_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'checkbox_logs'))
+LOG_FLUSH_SECONDS = float(os.environ.get('LOG_FLUSH_SECONDS', '1'))
+# copies of the live bitset written next to the file log for point-in-time lookups, see history.py
+KEYFRAME_SECONDS = int(os.environ.get('KEYFRAME_SECONDS', '300'))
+# without redis, where workers keep the shared bitset and their fanout sockets
+SHARED_STATE_DIR = os.environ.get('SHARED_STATE_DIR', '/dev/shm/one-million-checkboxes' if os.path.isdir('/dev/shm')
+                                  else os.path.join(tempfile.gettempdir(), 'one-million-checkboxes'))
+# snapshot the bitset to PERSIST_DIR every so often and journal toggles in between,
+# so a restarted worker can pick up where it left off without redis
+PERSIST = os.environ.get('PERSIST', 'true').lower() == 'true'
+PERSIST_DIR = os.environ.get('PERSIST_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state'))
+PERSIST_SNAPSHOT_SECONDS = int(os.environ.get('PERSIST_SNAPSHOT_SECONDS', '10'))
+PERSIST_JOURNAL_ROLL_SECONDS = int(os.environ.get('PERSIST_JOURNAL_ROLL_SECONDS', '60'))
+
+# (limit, window in seconds) pairs, all of which have to allow a toggle
+TOGGLE_RATE_LIMITS = [(7, 1), (80, 15), (240, 60)]
+CONNECTION_RATE_LIMITS = [(20, 15)]
+# reject clients that are over the limit in this worker before asking redis
+LOCAL_RATE_LIMIT_PRECHECK = os.environ.get('LOCAL_RATE_LIMIT_PRECHECK', 'true').lower() == 'true'
+
+# throttle any address (or IPv6 prefix) toggling more than HEAVY_HITTER_LIMIT times a second,
+# summed over every worker. Bots can rotate sids past the limits above but not addresses.
+# A limit of 0 still tracks the heaviest sources for /debug/heavy-hitters but throttles nobody.
+# Off unless asked for, one address can be a whole NAT or campus full of real people.
+HEAVY_HITTERS = os.environ.get('HEAVY_HITTERS', 'false').lower() == 'true'
+HEAVY_HITTER_LIMIT = float(os.environ.get('HEAVY_HITTER_LIMIT', '40'))
+HEAVY_HITTER_WINDOW_SECONDS = int(os.environ.get('HEAVY_HITTER_WINDOW_SECONDS', '10'))
+HEAVY_HITTER_MERGE_SECONDS = int(os.environ.get('HEAVY_HITTER_MERGE_SECONDS', '5'))
+HEAVY_HITTER_TOP = int(os.environ.get('HEAVY_HITTER_TOP', '32'))
+HEAVY_HITTER_IPV6_PREFIX = int(os.environ.get('HEAVY_HITTER_IPV6_PREFIX', '64'))
+# proxies in front of us that append to X-Forwarded-For, sources are keyed on the address the
+# outermost of them added. 0 means there's no proxy and the socket's address is used instead.
+HEAVY_HITTER_TRUSTED_PROXIES = int(os.environ.get('HEAVY_HITTER_TRUSTED_PROXIES', '1'))
+
+# /metrics is off unless METRICS_TOKEN is set, the /debug endpoints are off unless ADMIN_TOKEN is
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+# kill -USR2 <worker pid> starts profiling that worker, a second USR2 writes the stacks here
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', '30'))
+
+# dist/ is served from memory, files bigger than this are streamed from disk instead
+STATIC_PRELOAD_BYTES = int(os.environ.get('STATIC_PRELOAD_BYTES', str(2 * 1024 * 1024)))
+# for files in dist/ without a content hash in their name, other than index.html
+STATIC_MAX_AGE_SECONDS = int(os.environ.get('STATIC_MAX_AGE_SECONDS', '3600'))
+# how often to check dist/ for a new build, 0 to only load it at startup
+STATIC_RELOAD_SECONDS = float(os.environ.get('STATIC_RELOAD_SECONDS', '2'))
+
+WORKER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+TOGGLE_SECONDS = metrics.histogram('toggle_seconds', 'Time to handle one toggle_bit event')
+TOGGLE_STAGE_SECONDS = metrics.histogram(
+    'toggle_stage_seconds', 'Time spent in each stage of applying toggles', ['stage'])
+TOGGLES = metrics.counter('toggles_total', 'toggle_bit events by what happened to them', ['outcome'])
+TOGGLE_REDIS_ROUND_TRIPS = metrics.histogram(
+    'toggle_redis_round_trips', 'Redis round trips made while handling one toggle_bit event',
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8))
+REDIS_POOL_CHECKOUTS = metrics.counter(
+    'redis_pool_checkouts_total', 'Connections taken from the pool, one per command or pipeline', ['endpoint'])
+REDIS_POOL_WAIT_SECONDS = metrics.histogram(
+    'redis_pool_wait_seconds', 'Time spent waiting for a pooled connection', ['endpoint'])
+REDIS_POOL_EXHAUSTED = metrics.counter(
+    'redis_pool_exhausted_total', 'Commands that gave up waiting for a pooled connection', ['endpoint'])
+TOGGLE_BATCH_SIZE = metrics.histogram(
+    'toggle_batch_size', 'Toggles applied per ToggleBatcher flush', buckets=metrics.SIZE_BUCKETS)
+PUBSUB_MESSAGES = metrics.counter('pubsub_messages_total', 'Messages read from bit_toggle_channel')
+PUBSUB_BATCH_MESSAGES = metrics.histogram(
+    'pubsub_batch_messages', 'Pub/sub messages broadcast per batched_bit_toggles', buckets=metrics.SIZE_BUCKETS)
+PUBSUB_LAG_SECONDS = metrics.histogram(
+    'pubsub_lag_seconds', 'Age of the oldest toggle in a pub/sub batch when it is broadcast, by its sender\'s clock')
+PUBSUB_DROPPED = metrics.counter('pubsub_dropped_messages_total', 'Messages thrown away to resync instead')
+SNAPSHOT_BUILD_SECONDS = metrics.histogram('snapshot_build_seconds', 'Time to rebuild the full state snapshot')
+SNAPSHOT_BYTES = metrics.gauge('snapshot_bytes', 'Size of the current snapshot body', ['encoding'])
+FULL_STATE_BYTES = metrics.counter('full_state_bytes_total', 'Bytes of full_state pushed to clients')
+FANOUT_MESSAGES = metrics.counter('fanout_messages_total', 'Toggle batches received from other workers')
+FANOUT_DROPPED = metrics.counter('fanout_dropped_total', 'Toggle batches not sent because a worker was backed up')
+CONNECTED_CLIENTS = metrics.gauge('connected_clients', 'Socket.IO clients connected to this worker', ['wire'])
+PERSIST_SNAPSHOT_TIME = metrics.histogram(
+    'persist_snapshot_seconds', 'Time to write the bitset snapshot to disk')
+PERSIST_JOURNAL_RECORDS = metrics.counter('persist_journal_records_total', 'Toggles written to the journal')
+STATIC_RESPONSES = metrics.counter(
+    'static_responses_total', 'Responses for files in dist/ by where they came from', ['source'])
+HEAVY_HITTERS_FLAGGED = metrics.counter('heavy_hitters_flagged_total', 'Sources that went over HEAVY_HITTER_LIMIT')
+HEAVY_HITTERS_THROTTLED = metrics.gauge('heavy_hitters_throttled', 'Sources over HEAVY_HITTER_LIMIT as of the last merge')
+
+# redis round trips made by the current green thread, see InstrumentedConnectionPool
+redis_round_trips = threading.local()
+
+if PERSIST:
+    persistence = BitsetPersistence(PERSIST_DIR, WORKER_NAME, PERSIST_JOURNAL_ROLL_SECONDS)
+
+def restore_from_disk():
+    # the last snapshot with the journal replayed on top, or None if there's nothing to restore
+    if not PERSIST:
+        return None
+    started = time.time()
+    restored = persistence.restore(TOTAL_CHECKBOXES)
+    if restored is None:
+        return None
+    bits, replayed = restored
+    print(f"Restored {bits.count()} checked boxes from {PERSIST_DIR} "
+          f"({replayed} journal records) in {1000 * (time.time() - started):.1f}ms")
+    return bits
 
 class RedisRateLimiter:
-    def __init__(self, pool, limit, window):
-        self.pool = pool
-        self.limit = limit
-        self.window = window
+    # GCRA: each window keeps a single "theoretical arrival time" in one hash per key,
+    # and every window is checked and updated in the same atomic call. All in whole
+    # microseconds: fractional epoch milliseconds lose their fraction going through
+    # HSET, which let one fewer request through than the limit
+    script = """
+    local key = KEYS[1]
+    local redis_time = redis.call('TIME')
+    local now = tonumber(redis_time[1]) * 1000000 + tonumber(redis_time[2])
+
+    local new_tats = {}
+    local ttl = 0
+    for i = 1, #ARGV, 2 do
+        local limit = tonumber(ARGV[i])
+        local window = tonumber(ARGV[i + 1]) * 1000000
+        local tat = tonumber(redis.call('hget', key, window) or now)
+        if tat < now then
+            tat = now
+        end
+        local new_tat = tat + math.floor(window / limit)
+        if new_tat - now > window then
+            return 0
+        end
+        new_tats[#new_tats + 1] = window
+        new_tats[#new_tats + 1] = string.format('%d', new_tat)
+        if window > ttl then
+            ttl = window
+        end
+    end
+
+    redis.call('hset', key, unpack(new_tats))
+    redis.call('pexpire', key, math.floor(ttl / 1000))
+    return 1"""
+
+    def __init__(self, endpoint, limits):
+        self.endpoint = endpoint
+        self.limits = limits
+        self.args = [arg for limit, window in limits for arg in (limit, window)]
+        with get_redis_connection(endpoint) as redis_client:
+            self.sha = redis_client.script_load(self.script)
 
     def is_allowed(self, key: str) -> bool:
-        with get_redis_connection(self.pool) as redis_client:
-            pipe = redis_client.pipeline()
-            now = int(time.time())
-            key = f'rate_limit:{key}:{self.window}'  # Include window in the key
-            
-            pipe.zadd(key, {now: now})
-            pipe.zremrangebyscore(key, 0, now - self.window)
-            pipe.zcard(key)
-            pipe.expire(key, self.window)
-            
-            _, _, count, _ = pipe.execute()
-
-            return count <= self.limit
+        with get_redis_connection(self.endpoint) as redis_client:
+            return redis_client.evalsha(self.sha, 1, f'rate_limit:{key}', *self.args) == 1
+
+class LocalRateLimiter:
+    # the same GCRA as RedisRateLimiter, but only for what this worker has seen
+    def __init__(self, limits):
+        self.limits = limits
+        self.tats = {}
+
+    def is_allowed(self, key: str) -> bool:
+        now = time.time_ns() // 1000
+        tats = self.tats.get(key) or [now] * len(self.limits)
+        new_tats = []
+        for (limit, window), tat in zip(self.limits, tats):
+            window = window * 1_000_000
+            new_tat = max(tat, now) + window // limit
+            if new_tat - now > window:
+                return False
+            new_tats.append(new_tat)
+        self.tats[key] = new_tats
+        return True
+
+    def prune(self):
+        now = time.time_ns() // 1000
+        self.tats = {key: tats for key, tats in self.tats.items() if max(tats) > now}
+
+def burst_size(limiter, key):
+    # how many toggles in a row a fresh key gets, which should be the smallest limit
+    most = max(limit for limit, _ in limiter.limits)
+    allowed = 0
+    while allowed <= most and limiter.is_allowed(key):
+        allowed += 1
+    return allowed
+
+class BitsetMirror:
+    def __init__(self, size):
+        self.size = size
+        self.bitset = zeros(size)
+        self.count = 0
+
+    def load(self, raw):
+        bitset = bitarray()
+        bitset.frombytes(raw or b'')
+        if len(bitset) < self.size:
+            bitset.extend(zeros(self.size - len(bitset)))
+        del bitset[self.size:]
+        changed = bitset != self.bitset
+        self.bitset = bitset
+        self.count = bitset.count()
+        return changed
+
+    def apply(self, index, value):
+        value = 1 if value else 0
+        if self.bitset[index] == value:
+            return False
+        self.bitset[index] = value
+        self.count += 1 if value else -1
+        return True
 
 if USE_REDIS:
     import redis
-    from redis import ConnectionPool
-       # Create a connection pool
-    pool = ConnectionPool(
-            host=os.environ.get('REDIS_HOST', 'localhost'),
-            port=int(os.environ.get('REDIS_PORT', 6379)),
-            username=os.environ.get('REDIS_USERNAME', 'default'),
-            password=os.environ.get('REDIS_PASSWORD', ''),
-            db=0,
-            connection_class=redis.SSLConnection,
-            max_connections=425  # Adjust this number based on your needs
-            )
-    
-    replica_pool = ConnectionPool(
-            host=REDIS_REPLICA_IP,
-            port=int(os.environ.get('REDIS_PORT', 6379)),
-            username=os.environ.get('REDIS_USERNAME', 'default'),
-            password=os.environ.get('REDIS_PASSWORD', ''),
-            db=0,
-            connection_class=redis.SSLConnection,
-            max_connections=425  # Adjust this number based on your needs
-            )
-    
-    @contextmanager
-    def get_redis_connection(pool):
-        connection = redis.Redis(connection_pool=pool)
-        try:
-            yield connection
-        finally:
-            connection.close()
+    from redis import BlockingConnectionPool
+
+    class InstrumentedConnectionPool(BlockingConnectionPool):
+        # waits for a free connection instead of erroring, and keeps track of how long that takes
+        def __init__(self, name, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.name = name
+            self.reset_stats()
 
-    # redis_client = redis.Redis(connection_pool=pool)
-    # print("connected to redis")
-    # replica_client = redis.Redis(connection_pool=replica_pool)
-    # print("connected to replica")
+        def reset_stats(self):
+            self.checkouts = 0
+            self.exhausted = 0
+            self.wait_seconds = 0
+            self.max_wait_seconds = 0
 
+        def get_connection(self, *args, **kwargs):
+            started = time.time()
+            try:
+                connection = super().get_connection(*args, **kwargs)
+            except redis.ConnectionError as e:
+                # the pool gives up waiting with this, anything else is redis being unreachable
+                if str(e) == 'No connection available.':
+                    self.exhausted += 1
+                    REDIS_POOL_EXHAUSTED.inc(endpoint=self.name)
+                raise
+            waited = time.time() - started
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            REDIS_POOL_CHECKOUTS.inc(endpoint=self.name)
+            REDIS_POOL_WAIT_SECONDS.observe(waited, endpoint=self.name)
+            # every command or pipeline checks out exactly one connection, so this counts round trips
+            redis_round_trips.count = getattr(redis_round_trips, 'count', 0) + 1
+            return connection
+
+    class RedisEndpoint:
+        # one long-lived client per redis server, shared by every greenlet; connections go
+        # back to a LIFO pool after each command so busy greenlets keep reusing warm TLS sessions
+        def __init__(self, name, host, port):
+            self.name = name
+            self.host = host
+            self.port = port
+            self.pool = InstrumentedConnectionPool(
+                name,
+                host=host,
+                port=port,
+                username=os.environ.get('REDIS_USERNAME', 'default'),
+                password=os.environ.get('REDIS_PASSWORD', ''),
+                db=0,
+                connection_class=redis.SSLConnection if REDIS_SSL else redis.Connection,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT_SECONDS,
+                health_check_interval=30,
+                )
+            self.redis = redis.Redis(connection_pool=self.pool)
+
+        def client(self):
+            return self.redis
+
+        def pipeline(self):
+            # no MULTI/EXEC, we only pipeline to save round trips
+            return self.redis.pipeline(transaction=False)
+
+        def is_healthy(self):
+            try:
+                return self.redis.ping()
+            except redis.RedisError:
+                return False
+
+        def report(self):
+            pool = self.pool
+            if pool.checkouts:
+                print(f"Redis pool {self.name}: {pool.checkouts} checkouts, "
+                      f"avg wait {1000 * pool.wait_seconds / pool.checkouts:.2f}ms, "
+                      f"max wait {1000 * pool.max_wait_seconds:.1f}ms, exhausted {pool.exhausted}")
+            pool.reset_stats()
+
+    class ReplicaSet:
+        # reads go to the first healthy replica, and to the primary if none are
+        def __init__(self, primary, endpoints):
+            self.primary = primary
+            self.endpoints = endpoints
+            self.active = endpoints[0] if endpoints else primary
+
+        def client(self):
+            return self.active.client()
+
+        def pipeline(self):
+            return self.active.pipeline()
+
+        def check(self):
+            for endpoint in self.endpoints:
+                if endpoint.is_healthy():
+                    if endpoint is not self.active:
+                        print(f"Reading from replica {endpoint.host}:{endpoint.port}")
+                        self.active = endpoint
+                    return
+            if self.active is not self.primary:
+                print("No healthy replica, reading from the primary")
+                self.active = self.primary
+
+        def report(self):
+            for endpoint in self.endpoints:
+                endpoint.report()
+
+    def parse_address(address, default_port):
+        host, _, port = address.strip().partition(':')
+        return host, int(port or default_port)
+
+    def discover_replicas(primary, hosts, prefix=''):
+        # host[:port] addresses win, otherwise ask the primary who is replicating from it
+        if hosts:
+            addresses = [parse_address(host, primary.port) for host in hosts]
+        else:
+            info = primary.client().info('replication')
+            addresses = [(value['ip'], int(value['port'])) for key, value in info.items()
+                         if key.startswith('slave') and isinstance(value, dict) and value.get('state') == 'online']
+        return [RedisEndpoint(f'{prefix}replica{i}', host, host_port) for i, (host, host_port) in enumerate(addresses)]
+
+    primary = RedisEndpoint('primary', os.environ.get('REDIS_HOST', 'localhost'), int(os.environ.get('REDIS_PORT', 6379)))
+    replicas = ReplicaSet(primary, discover_replicas(
+        primary, [host for host in os.environ.get('REDIS_REPLICA_HOSTS', '').split(',') if host.strip()]))
+    replicas.check()
+
+    class Shard:
+        # one range of boxes with its own bitset, count and channel, usually on its own redis
+        def __init__(self, number, start, end, primary, replicas, suffix):
+            self.number = number
+            self.start = start
+            self.end = end
+            self.size = end - start
+            self.primary = primary
+            self.replicas = replicas
+            self.bitset_key = f'truncated_bitset{suffix}'
+            self.count_key = f'count{suffix}'
+            self.channel = f'bit_toggle_channel{suffix}'
+
+    def build_shards():
+        specs = [spec for spec in REDIS_SHARDS.split(',') if spec.strip()]
+        if not specs:
+            return [Shard(0, 0, TOTAL_CHECKBOXES, primary, replicas, '')]
+
+        # whole chunks per shard, so a chunk never has to be stitched together from two of them
+        shard_size = -(-TOTAL_CHUNKS // len(specs)) * CHUNK_SIZE
+        endpoints = {(primary.host, primary.port): primary}
+        shards = []
+        for number, spec in enumerate(specs):
+            address, *replica_hosts = spec.split('/')
+            host, port = parse_address(address, primary.port)
+            if (host, port) not in endpoints:
+                endpoints[(host, port)] = RedisEndpoint(f'shard{number}', host, port)
+            shard_primary = endpoints[(host, port)]
+            if shard_primary is primary and not replica_hosts:
+                shard_replicas = replicas
+            else:
+                shard_replicas = ReplicaSet(shard_primary, discover_replicas(shard_primary, replica_hosts, f'shard{number}-'))
+                shard_replicas.check()
+            start = min(number * shard_size, TOTAL_CHECKBOXES)
+            shards.append(Shard(number, start, min(start + shard_size, TOTAL_CHECKBOXES),
+                                shard_primary, shard_replicas, f':{number}'))
+        return shards
+
+    shards = build_shards()
+
+    def shard_for(index):
+        return shards[index // shards[0].size]
+
+    def split_by_shard(true_updates, false_updates):
+        by_shard = {}
+        for index in true_updates:
+            by_shard.setdefault(shard_for(index), ([], []))[0].append(index)
+        for index in false_updates:
+            by_shard.setdefault(shard_for(index), ([], []))[1].append(index)
+        return by_shard
+
+    # every distinct redis we talk to, for health checks and pool reports
+    redis_primaries = list({id(endpoint): endpoint for endpoint in [primary] + [shard.primary for shard in shards]}.values())
+    replica_sets = list({id(replica_set): replica_set for replica_set in [replicas] + [shard.replicas for shard in shards]}.values())
+
+    def check_replicas():
+        for replica_set in replica_sets:
+            replica_set.check()
+
+    def report_redis_pools():
+        for endpoint in redis_primaries:
+            endpoint.report()
+        for replica_set in replica_sets:
+            replica_set.report()
+
+    @contextmanager
+    def get_redis_connection(endpoint):
+        # nothing is created or closed per call anymore, this just hands out the shared client
+        yield endpoint.client()
+
+    disk_state = restore_from_disk()
 
     def initialize_redis():
-        with get_redis_connection(pool) as redis_client:
-            if not redis_client.exists('truncated_bitset'):
-                redis_client.set('truncated_bitset', b'\x00' * (TOTAL_CHECKBOXES // 8))
-            if not redis_client.exists('count'):
-                redis_client.set('count', '0')
+        for shard in shards:
+            with get_redis_connection(shard.primary) as redis_client:
+                if not redis_client.exists(shard.bitset_key):
+                    # redis lost everything, start it off from our copy on disk if we have one
+                    part = None if disk_state is None else disk_state[shard.start:shard.end]
+                    raw = b'\x00' * (shard.size // 8) if part is None else part.tobytes()
+                    if redis_client.set(shard.bitset_key, raw, nx=True) and part is not None:
+                        print(f"Seeded {shard.bitset_key} with the bitset from disk")
+                        redis_client.set(shard.count_key, part.count())
+                if not redis_client.exists(shard.count_key):
+                    redis_client.set(shard.count_key, '0')
 
     initialize_redis()
 
-    # pubsub = replica_client.pubsub(ignore_subscribe_messages=True)
-    pubsub = redis.Redis(connection_pool=replica_pool).pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe('bit_toggle_channel')
+    def open_toggle_pubsub(shard):
+        pubsub = shard.replicas.client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(shard.channel)
+        return pubsub
 
     # Lua script for atomic bit setting and count update
     set_bit_script = """
@@ -136,114 +558,325 @@ if USE_REDIS:
 
     return {new_bit, diff}  -- new bit value, and the change (1, 0, or -1)"""
 
+    # same rules as new_set_bit_script, applied to every index in ARGV[2..] in order
+    toggle_many_script = """
+    local key = KEYS[1]
+    local count_key = KEYS[2]
+    local max_count = tonumber(ARGV[1])
+
+    local current_count = tonumber(redis.call('get', count_key) or "0")
+    local results = {}
+
+    for i = 2, #ARGV do
+        local index = tonumber(ARGV[i])
+        local current_bit = redis.call('getbit', key, index)
+        local new_bit = 1 - current_bit
+        local diff = new_bit - current_bit
+
+        if current_count >= max_count or (diff > 0 and current_count + diff > max_count) then
+            results[#results + 1] = {current_bit, 0}
+        else
+            redis.call('setbit', key, index, new_bit)
+            current_count = current_count + diff
+            results[#results + 1] = {new_bit, diff}
+        end
+    end
+
+    redis.call('set', count_key, current_count)
+    return results"""
+
     # set_bit_sha = redis_client.script_load(set_bit_script)
-    # new_set_bit_sha = redis_client.script_load(new_set_bit_script)
-    with get_redis_connection(pool) as redis_client:
-        new_set_bit_sha = redis_client.script_load(new_set_bit_script)
+    # every shard's redis gets its own copy of the scripts. They see shard-local indices and
+    # the shard's size as the max count, so a shard stops taking toggles once it's full,
+    # which is the same as the old global check since all shards are full once the total is
+    for shard in shards:
+        with get_redis_connection(shard.primary) as redis_client:
+            shard.new_set_bit_sha = redis_client.script_load(new_set_bit_script)
+            shard.toggle_many_sha = redis_client.script_load(toggle_many_script)
 
-    def get_bit(index):
-        with get_redis_connection(pool) as redis_client:
-            return bool(redis_client.getbit('truncated_bitset', index))
+    mirror = BitsetMirror(TOTAL_CHECKBOXES)
+    if disk_state is not None:
+        mirror.load(disk_state.tobytes())
+
+    def read_shards():
+        # the whole bitset, assembled by concatenating every shard in order
+        parts = []
+        for shard in shards:
+            with get_redis_connection(shard.replicas) as replica_client:
+                raw_data = replica_client.get(shard.bitset_key) or b''
+            parts.append(raw_data[:shard.size // 8].ljust(shard.size // 8, b'\x00'))
+        return b''.join(parts)
+
+    def resync_mirror():
+        raw_data = read_shards()
+        # messages published before the GET get replayed on top of this, which is
+        # fine since every message carries the absolute value of its bit
+        if mirror.load(raw_data):
+            print(f"Mirror resynced from redis, count is now {mirror.count}")
+            snapshot_cache.invalidate()
+
+    if LOCAL_MIRROR:
+        def get_bit(index):
+            return bool(mirror.bitset[index])
+    else:
+        def get_bit(index):
+            shard = shard_for(index)
+            with get_redis_connection(shard.primary) as redis_client:
+                return bool(redis_client.getbit(shard.bitset_key, index - shard.start))
     
     def set_bit(index, value):
-        with get_redis_connection(pool) as redis_client:
-            [_count, diff] = redis_client.evalsha(new_set_bit_sha, 1, 'truncated_bitset', index, int(value))
-            return diff != 0
+        if get_bit(index) == bool(value):
+            return False
+        did_toggle, _ = _toggle_internal(index)
+        return did_toggle
 
     def _toggle_internal(index):
-        with get_redis_connection(pool) as redis_client:
+        shard = shard_for(index)
+        with get_redis_connection(shard.primary) as redis_client:
             result = redis_client.evalsha(
-                new_set_bit_sha, 
+                shard.new_set_bit_sha, 
                 2,  # number of keys
-                'truncated_bitset',  # key for bitset
-                'count',  # key for count
-                index,  # index to toggle
-                TOTAL_CHECKBOXES  # max count
+                shard.bitset_key,  # key for bitset
+                shard.count_key,  # key for count
+                index - shard.start,  # index to toggle
+                shard.size  # max count
             )
             new_bit_value, diff = result
             if diff == 0:
                 return [False, None]
+            if LOCAL_MIRROR and mirror.apply(index, new_bit_value):
+                snapshot_cache.invalidate()
             return [True, new_bit_value]
+
+    def _toggle_many(indices):
+        # one script call per shard, each seeing its boxes in the order they were clicked
+        positions_by_shard = {}
+        for position, index in enumerate(indices):
+            positions_by_shard.setdefault(shard_for(index), []).append(position)
+        results = [None] * len(indices)
+        for shard, positions in positions_by_shard.items():
+            with get_redis_connection(shard.primary) as redis_client:
+                shard_results = redis_client.evalsha(
+                    shard.toggle_many_sha,
+                    2,
+                    shard.bitset_key,
+                    shard.count_key,
+                    shard.size,
+                    *[indices[position] - shard.start for position in positions]
+                )
+            for position, result in zip(positions, shard_results):
+                results[position] = result
+
+        toggles = []
+        for index, (new_bit_value, diff) in zip(indices, results):
+            if diff == 0:
+                toggles.append([False, None])
+                continue
+            if LOCAL_MIRROR and mirror.apply(index, new_bit_value):
+                snapshot_cache.invalidate()
+            toggles.append([True, new_bit_value])
+        return toggles
     
-    def get_full_state():
-        with get_redis_connection(replica_pool) as replica_client:
-            raw_data = replica_client.get("truncated_bitset")
-            return base64.b64encode(raw_data).decode('utf-8')
+    if LOCAL_MIRROR:
+        def get_raw_state():
+            return mirror.bitset.tobytes()
 
-    def get_count():
-        with get_redis_connection(replica_pool) as replica_client:
-            return int(replica_client.get('count') or 0)
+        def get_raw_chunks(chunk_ids):
+            return {chunk_id: mirror.bitset[chunk_id * CHUNK_SIZE:(chunk_id + 1) * CHUNK_SIZE].tobytes()
+                    for chunk_id in chunk_ids}
+
+        def get_count():
+            return mirror.count
+    else:
+        def get_raw_state():
+            return read_shards()
+
+        def get_raw_chunks(chunk_ids):
+            chunk_bytes = CHUNK_SIZE // 8
+            chunks_by_shard = {}
+            for chunk_id in chunk_ids:
+                chunks_by_shard.setdefault(shard_for(chunk_id * CHUNK_SIZE), []).append(chunk_id)
+            raw_chunks = {}
+            for shard, shard_chunk_ids in chunks_by_shard.items():
+                pipe = shard.replicas.pipeline()
+                for chunk_id in shard_chunk_ids:
+                    start = (chunk_id * CHUNK_SIZE - shard.start) // 8
+                    pipe.getrange(shard.bitset_key, start, start + chunk_bytes - 1)
+                raw_chunks.update(zip(shard_chunk_ids, pipe.execute()))
+            return raw_chunks
+
+        # adding up every shard's count is a round trip per shard, so the total is only
+        # re-read once it's older than SHARD_COUNT_CACHE_SECONDS
+        shard_count_cache = {'count': 0, 'read_at': 0}
+
+        def get_count():
+            if time.time() - shard_count_cache['read_at'] >= SHARD_COUNT_CACHE_SECONDS:
+                count = 0
+                for shard in shards:
+                    with get_redis_connection(shard.replicas) as replica_client:
+                        count += int(replica_client.get(shard.count_key) or 0)
+                shard_count_cache['count'] = count
+                shard_count_cache['read_at'] = time.time()
+            return shard_count_cache['count']
     
     def emit_toggle(index, new_value, timestamp):
-        with get_redis_connection(pool) as redis_client:
-            redis_client.publish('bit_toggle_channel', json.dumps([index, new_value, timestamp]))
+        if BINARY_PUBSUB:
+            if new_value:
+                emit_toggles([index], [], timestamp)
+            else:
+                emit_toggles([], [index], timestamp)
+            return
+        shard = shard_for(index)
+        with get_redis_connection(shard.primary) as redis_client:
+            redis_client.publish(shard.channel, json.dumps([index, new_value, timestamp]))
 
-    one_second_limiter = RedisRateLimiter(pool, limit=7, window=1)
-    fifteen_second_limiter = RedisRateLimiter(pool, limit=80, window=15)
-    sixty_second_limiter = RedisRateLimiter(pool, limit=240, window=60)
-    
-    connection_limiter = RedisRateLimiter(pool, limit=20, window=15)
+    def emit_toggles(true_updates, false_updates, timestamp):
+        # each shard's toggles go out on its own channel, still with their global indices
+        for shard, (shard_true, shard_false) in split_by_shard(true_updates, false_updates).items():
+            if BINARY_PUBSUB:
+                message = encode_toggles(shard_true, shard_false, timestamp)
+            else:
+                message = json.dumps([shard_true, shard_false, timestamp])
+            with get_redis_connection(shard.primary) as redis_client:
+                redis_client.publish(shard.channel, message)
 
-    limiters = [one_second_limiter, fifteen_second_limiter, sixty_second_limiter]
+    toggle_limiter = RedisRateLimiter(primary, TOGGLE_RATE_LIMITS)
+    local_toggle_limiter = LocalRateLimiter(TOGGLE_RATE_LIMITS)
+    
+    connection_limiter = RedisRateLimiter(primary, CONNECTION_RATE_LIMITS)
 
     def allow_toggle(key):
-        return all(limiter.is_allowed(key) for limiter in limiters)
+        if LOCAL_RATE_LIMIT_PRECHECK and not local_toggle_limiter.is_allowed(key):
+            return False
+        return toggle_limiter.is_allowed(key)
     
     def allow_connection(key):
         return connection_limiter.is_allowed(key)
 
-    def log_checkbox_toggle(remote_ip, checkbox_index, checked_state):
-        timestamp = datetime.now().isoformat()
-        log_entry = f"{timestamp}|{remote_ip}|{checkbox_index}|{checked_state}"
-
-        # Use the current date as part of the key
-        key = f"checkbox_logs:{datetime.now().strftime('%Y-%m-%d')}"
-        with get_redis_connection(pool) as redis_client:
-            pipeline = redis_client.pipeline()
-            pipeline.rpush(key, log_entry)
+    def check_rate_limiters():
+        # the local precheck and redis have to agree, or one of them is cutting people off early
+        key = f'burst-check:{WORKER_NAME}:{time.time_ns()}'
+        redis_burst = burst_size(toggle_limiter, key)
+        local_burst = burst_size(LocalRateLimiter(TOGGLE_RATE_LIMITS), key)
+        if redis_burst != local_burst:
+            print(f"Rate limiters disagree: redis allows a burst of {redis_burst}, the local one {local_burst}")
+
+    def exchange_heavy_hitter_summaries(summary):
+        # each worker's summary lives in its own expiring key, so dead workers drop out by themselves
+        with get_redis_connection(primary) as redis_client:
+            pipe = redis_client.pipeline()
+            pipe.set(f'heavy_hitters:{WORKER_NAME}', summary, ex=HEAVY_HITTER_WINDOW_SECONDS * 3)
+            pipe.sadd('heavy_hitter_workers', WORKER_NAME)
+            pipe.smembers('heavy_hitter_workers')
+            workers = [worker.decode('utf-8') for worker in pipe.execute()[2]]
+            others = [worker for worker in workers if worker != WORKER_NAME]
+            if not others:
+                return []
+            summaries = redis_client.mget([f'heavy_hitters:{worker}' for worker in others])
+            gone = [worker for worker, summary in zip(others, summaries) if summary is None]
+            if gone:
+                redis_client.srem('heavy_hitter_workers', *gone)
+            return [summary for summary in summaries if summary is not None]
+
+    if LOG_SINK == 'redis':
+        def log_checkbox_toggle(remote_ip, checkbox_index, checked_state):
+            log_checkbox_toggles([(remote_ip, checkbox_index, checked_state)])
+
+        def log_checkbox_toggles(entries):
+            now = datetime.now()
+            timestamp = now.isoformat()
+            log_entries = [f"{timestamp}|{remote_ip}|{checkbox_index}|{checked_state}"
+                           for remote_ip, checkbox_index, checked_state in entries]
+
+            # Use the current date as part of the key
+            key = f"checkbox_logs:{now.strftime('%Y-%m-%d')}"
+            pipeline = primary.pipeline()
+            pipeline.rpush(key, *log_entries)
             pipeline.ltrim(key, 0, MAX_LOGS_PER_DAY - 1)
             pipeline.execute()
 
 else:
-    # In-memory storage
-    in_memory_storage = {'bitset': bitarray('0' * TOTAL_CHECKBOXES), 'count': 0}
+    # Without redis the bitset lives in shared memory, so every worker on the box sees the same
+    # boxes, and toggles are passed between workers over unix sockets. See shared_state.py.
+    def load_from_disk(bitset):
+        restored = restore_from_disk()
+        if restored is not None:
+            bitset[:] = restored
+
+    # only the first worker to start after a reboot creates the shared bitset and loads it from disk
+    shared_bitset = SharedBitset(os.path.join(SHARED_STATE_DIR, 'bitset'), TOTAL_CHECKBOXES, load_from_disk)
+    fanout = WorkerFanout(os.path.join(SHARED_STATE_DIR, 'workers'), WORKER_NAME)
 
     def get_bit(index):
-        return bool(in_memory_storage['bitset'][index])
+        return bool(shared_bitset.bitset[index])
 
     def set_bit(index, value):
-        current = in_memory_storage['bitset'][index]
-        count = in_memory_storage['count']
-        if count >= TOTAL_CHECKBOXES:
+        if not shared_bitset.set(index, value):
             return False
-        
-        in_memory_storage['bitset'][index] = value
-        in_memory_storage['count'] += value - current
+        if PERSIST:
+            persistence.record(index, value)
+        snapshot_cache.invalidate()
         return True
     
     def _toggle_internal(index):
-        print("here")
-        current = in_memory_storage['bitset'][index]
-        count = in_memory_storage['count']
-        if count >= TOTAL_CHECKBOXES:
+        new_value = shared_bitset.toggle(index)
+        if new_value is None:
             return [False, None]
-        
-        new_value = not current
-        in_memory_storage['bitset'][index] = new_value
-        in_memory_storage['count'] += 1 if new_value else -1
+        if PERSIST:
+            persistence.record(index, new_value)
+        snapshot_cache.invalidate()
         return [True, new_value]
 
-    def get_full_state():
-        return base64.b64encode(in_memory_storage['bitset'].tobytes()).decode('utf-8')
+    def _toggle_many(indices):
+        return [_toggle_internal(index) for index in indices]
+
+    def get_raw_state():
+        return shared_bitset.bitset.tobytes()
+
+    def get_raw_chunks(chunk_ids):
+        bitset = shared_bitset.bitset
+        return {chunk_id: bitset[chunk_id * CHUNK_SIZE:(chunk_id + 1) * CHUNK_SIZE].tobytes()
+                for chunk_id in chunk_ids}
     
     def get_count():
-        return in_memory_storage['count']
+        return shared_bitset.count()
     
     def emit_toggle(index, new_value, timestamp):
-        update = [[index], [], timestamp] if new_value else [[], [index], timestamp]
-        socketio.emit('batched_bit_toggles', update)
-    
-    limiters = []
+        if new_value:
+            emit_toggles([index], [], timestamp)
+        else:
+            emit_toggles([], [index], timestamp)
+
+    def emit_toggles(true_updates, false_updates, timestamp):
+        broadcast_toggles(true_updates, false_updates, timestamp)
+        fanout.publish(encode_toggles(true_updates, false_updates, timestamp))
+
+    def listen_to_workers():
+        while True:
+            try:
+                data = fanout.receive()
+                if data == DROPPED_NOTICE:
+                    resync_after_fanout_drop()
+                    continue
+                true_updates, false_updates, timestamp = decode_toggles(data)
+            except Exception as e:
+                print(f"Failed to read toggles from another worker: {e}")
+                continue
+            FANOUT_MESSAGES.inc()
+            broadcast_toggles(true_updates, false_updates, timestamp)
+
+    def resync_after_fanout_drop():
+        # the shared bitset is fine, but our clients and change ring missed some toggles
+        print("Another worker dropped toggles meant for us, resyncing our clients")
+        change_ring.drop_before(int(time.time() * 1000))
+        resync_clients()
+
+    def report_fanout():
+        FANOUT_DROPPED.inc(fanout.dropped)
+        if fanout.dropped:
+            print(f"Worker fanout: sent {fanout.sent} messages to {len(fanout.peers)} workers, dropped {fanout.dropped}")
+        fanout.sent = 0
+        fanout.dropped = 0
 
     def allow_toggle(key):
         return True
@@ -251,54 +884,714 @@ else:
     def allow_connection(key):
         return True
 
+    def exchange_heavy_hitter_summaries(summary):
+        # same idea as the redis version, with a file per worker next to the shared bitset
+        directory = os.path.join(SHARED_STATE_DIR, 'heavy_hitters')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{WORKER_NAME}.hh')
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(summary)
+        os.replace(f'{path}.tmp', path)
+
+        summaries = []
+        for name in os.listdir(directory):
+            other = os.path.join(directory, name)
+            if other == path or not name.endswith('.hh'):
+                continue
+            try:
+                if time.time() - os.path.getmtime(other) > HEAVY_HITTER_WINDOW_SECONDS * 3:
+                    os.remove(other)
+                    continue
+                with open(other, 'rb') as f:
+                    summaries.append(f.read())
+            except FileNotFoundError:
+                pass
+        return summaries
+
+    if LOG_SINK == 'redis':
+        def log_checkbox_toggle(remote_ip, checkbox_index, checked_state):
+            pass
+
+        def log_checkbox_toggles(entries):
+            pass
+
+if LOG_SINK == 'file':
+    checkbox_log = CheckboxLogWriter(CHECKBOX_LOG_DIR, WORKER_NAME)
+
     def log_checkbox_toggle(remote_ip, checkbox_index, checked_state):
-        pass
+        checkbox_log.append(remote_ip, checkbox_index, checked_state, int(time.time() * 1000))
+
+    def log_checkbox_toggles(entries):
+        timestamp = int(time.time() * 1000)
+        for remote_ip, checkbox_index, checked_state in entries:
+            checkbox_log.append(remote_ip, checkbox_index, checked_state, timestamp)
+
+    keyframe_lock = None
+
+    def write_live_keyframe():
+        # the grid as it is, not a replay of this host's log, which misses the other hosts
+        # and everything from before file logging. Filling in between these from a collected
+        # log is `python history.py <dir> build`, out of process
+        global keyframe_lock
+        if keyframe_lock is None:
+            keyframe_lock = lock_keyframes(CHECKBOX_LOG_DIR)
+            if keyframe_lock is None:
+                return
+        try:
+            timestamp = int(time.time() * 1000)
+            raw = get_raw_state()
+            # compressing a megabit is slow enough to hold up this worker's sockets
+            tpool.execute(write_keyframe, CHECKBOX_LOG_DIR, live_keyframe(CHECKBOX_LOG_DIR, raw, TOTAL_CHECKBOXES, timestamp))
+        except Exception as e:
+            print(f"Failed to write history keyframe: {e}")
+
+    def flush_checkbox_log():
+        while True:
+            socketio.sleep(LOG_FLUSH_SECONDS)
+            try:
+                checkbox_log.flush()
+            except Exception as e:
+                print(f"Failed to write checkbox log: {e}")
+
+class ToggleBatcher:
+    def __init__(self, interval_ms, max_size):
+        self.interval = interval_ms / 1000
+        self.max_size = max_size
+        self.pending = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batches = 0
+        self.toggles = 0
+        self.max_batch = 0
+        self.apply_seconds = 0
+        self.max_apply_seconds = 0
+        self.max_wait_seconds = 0
+
+    def submit(self, index, remote_ip):
+        self.pending.append((index, remote_ip, time.time()))
+
+    def run(self):
+        while True:
+            socketio.sleep(self.interval)
+            while self.pending:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Failed to apply toggle batch: {e}")
+
+    def flush(self):
+        batch = self.pending[:self.max_size]
+        del self.pending[:self.max_size]
+
+        started = time.time()
+        with TOGGLE_STAGE_SECONDS.time(stage='batch_toggle'):
+            results = _toggle_many([index for index, _, _ in batch])
+        timestamp = int(time.time() * 1000)  # Current time in milliseconds
+
+        # the same box can be clicked several times in one batch, only its final value goes out
+        final_values = {}
+        log_entries = []
+        for (index, remote_ip, _), (did_toggle, new_value) in zip(batch, results):
+            if did_toggle:
+                final_values[index] = new_value
+                log_entries.append((remote_ip, index, new_value))
+
+        if final_values:
+            with TOGGLE_STAGE_SECONDS.time(stage='batch_log'):
+                log_checkbox_toggles(log_entries)
+            true_updates = [index for index, value in final_values.items() if value]
+            false_updates = [index for index, value in final_values.items() if not value]
+            with TOGGLE_STAGE_SECONDS.time(stage='batch_publish'):
+                emit_toggles(true_updates, false_updates, timestamp)
+
+        finished = time.time()
+        TOGGLE_BATCH_SIZE.observe(len(batch))
+        self.batches += 1
+        self.toggles += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.apply_seconds += finished - started
+        self.max_apply_seconds = max(self.max_apply_seconds, finished - started)
+        self.max_wait_seconds = max(self.max_wait_seconds, finished - batch[0][2])
+
+    def report(self):
+        if self.batches:
+            print(f"Toggle batches: {self.batches} batches, {self.toggles} toggles, "
+                  f"avg size {self.toggles / self.batches:.1f}, max size {self.max_batch}, "
+                  f"avg apply {1000 * self.apply_seconds / self.batches:.1f}ms, "
+                  f"max apply {1000 * self.max_apply_seconds:.1f}ms, "
+                  f"max wait {1000 * self.max_wait_seconds:.1f}ms")
+        self.reset_stats()
+
+toggle_batcher = ToggleBatcher(TOGGLE_BATCH_INTERVAL_MS, TOGGLE_BATCH_MAX)
+
+class Snapshot:
+    def __init__(self, raw, count, timestamp):
+        self.payload = {
+            'full_state': base64.b64encode(raw).decode('utf-8'),
+            'count': count,
+            'timestamp': timestamp,
+        }
+        self.body = json.dumps(self.payload).encode('utf-8')
+        # content-based so every worker hands out the same etag for the same bitset
+        self.etag = f'{zlib.crc32(raw):08x}-{count}'
+        self.encoded = {'identity': self.body}
+
+    def body_for(self, encoding):
+        if encoding not in self.encoded:
+            if encoding == 'br':
+                self.encoded[encoding] = brotli.compress(self.body, quality=5)
+            else:
+                self.encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+            SNAPSHOT_BYTES.set(len(self.encoded[encoding]), encoding=encoding)
+        return self.encoded[encoding]
+
+class SnapshotCache:
+    def __init__(self, min_rebuild_seconds, max_age_seconds):
+        self.min_rebuild_seconds = min_rebuild_seconds
+        self.max_age_seconds = max_age_seconds
+        self.version = 0
+        self.snapshot = None
+        self.snapshot_version = -1
+        self.built_at = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.version += 1
+
+    def is_stale(self):
+        if self.snapshot is None:
+            return True
+        age = time.time() - self.built_at
+        if age >= self.max_age_seconds:
+            return True
+        return self.snapshot_version != self.version and age >= self.min_rebuild_seconds
+
+    def get(self):
+        if self.is_stale():
+            with self.lock:
+                # someone else may have rebuilt while we waited on the lock
+                if self.is_stale():
+                    self.rebuild()
+        return self.snapshot
+
+    def rebuild(self):
+        version = self.version
+        with SNAPSHOT_BUILD_SECONDS.time():
+            raw = get_raw_state()
+            count = get_count()
+            timestamp = int(time.time() * 1000)  # Current time in milliseconds
+            self.snapshot = Snapshot(raw, count, timestamp)
+        SNAPSHOT_BYTES.set(len(self.snapshot.body), encoding='identity')
+        self.snapshot_version = version
+        self.built_at = time.time()
+
+snapshot_cache = SnapshotCache(SNAPSHOT_MIN_REBUILD_SECONDS, SNAPSHOT_MAX_AGE_SECONDS)
 
 def state_snapshot():
-    full_state = get_full_state()
-    count = get_count()
+    return snapshot_cache.get().payload
+
+def pick_encoding(accept_encodings):
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return 'identity'
+
+class ChangeRing:
+    def __init__(self, max_batches, lag_margin_ms):
+        self.batches = deque(maxlen=max_batches)
+        # the newest timestamp recorded up to and including each batch. Batches can arrive a
+        # little out of order, but this never goes down, so it can be binary searched
+        self.high_water = deque(maxlen=max_batches)
+        self.lag_margin_ms = lag_margin_ms
+        # we've seen every change stamped after this
+        self.floor = int(time.time() * 1000)
+
+    def record(self, true_updates, false_updates, timestamp):
+        if len(self.batches) == self.batches.maxlen:
+            self.floor = max(self.floor, self.batches[0][0])
+        self.batches.append((timestamp, true_updates, false_updates))
+        self.high_water.append(max(timestamp, self.high_water[-1]) if self.high_water else timestamp)
+
+    def drop_before(self, timestamp):
+        # changes stamped before this may have been lost, asking from earlier gets a full snapshot
+        self.floor = max(self.floor, timestamp)
+
+    def changes_since(self, since):
+        since = since - self.lag_margin_ms
+        if since < self.floor:
+            return None
+
+        values = {}
+        latest = 0
+        # everything before the first batch whose high water is past since is stamped at or before it
+        start = bisect_right(self.high_water, since)
+        for i in range(start, len(self.batches)):
+            timestamp, true_updates, false_updates = self.batches[i]
+            if timestamp <= since:
+                continue
+            for index in true_updates:
+                values[index] = True
+            for index in false_updates:
+                values[index] = False
+            latest = max(latest, timestamp)
+
+        true_updates = [index for index, value in values.items() if value]
+        false_updates = [index for index, value in values.items() if not value]
+        return [true_updates, false_updates, latest]
+
+change_ring = ChangeRing(CHANGE_RING_SIZE, CHANGE_LAG_MARGIN_MS)
+
+# timestamp of the newest change we've seen in each chunk
+chunk_versions = [0] * TOTAL_CHUNKS
+
+class ChunkSubscriptions:
+    def __init__(self):
+        self.by_sid = {}
+        self.subscribers = [0] * TOTAL_CHUNKS
+
+    def subscribe(self, sid, chunk_ids, limit):
+        # the chunks newly subscribed to, or None if that would take sid past the limit
+        subscribed = self.by_sid.get(sid, set())
+        added = [chunk_id for chunk_id in chunk_ids if chunk_id not in subscribed]
+        if len(subscribed) + len(added) > limit:
+            return None
+        subscribed = self.by_sid.setdefault(sid, subscribed)
+        for chunk_id in added:
+            subscribed.add(chunk_id)
+            self.subscribers[chunk_id] += 1
+        return added
+
+    def unsubscribe(self, sid, chunk_ids):
+        subscribed = self.by_sid.get(sid, set())
+        removed = [chunk_id for chunk_id in chunk_ids if chunk_id in subscribed]
+        for chunk_id in removed:
+            subscribed.discard(chunk_id)
+            self.subscribers[chunk_id] -= 1
+        if not subscribed:
+            self.by_sid.pop(sid, None)
+        return removed
+
+    def remove(self, sid):
+        return self.unsubscribe(sid, list(self.by_sid.get(sid, ())))
+
+    def is_subscribed(self, sid):
+        return sid in self.by_sid
+
+chunk_subscriptions = ChunkSubscriptions()
+
+def split_by_chunk(true_updates, false_updates):
+    by_chunk = {}
+    for index in true_updates:
+        by_chunk.setdefault(index // CHUNK_SIZE, ([], []))[0].append(index)
+    for index in false_updates:
+        by_chunk.setdefault(index // CHUNK_SIZE, ([], []))[1].append(index)
+    return by_chunk
+
+# sids that asked for toggle_codec frames instead of JSON, they live in the ':bin' rooms
+binary_sids = set()
+
+def room_for(sid, room):
+    return f'{room}:bin' if sid in binary_sids else room
+
+def emit_batch(true_updates, false_updates, timestamp, room):
+    socketio.emit('batched_bit_toggles', [true_updates, false_updates, timestamp], to=room)
+    if binary_sids:
+        socketio.emit('batched_bit_toggles', encode_toggles(true_updates, false_updates, timestamp),
+                      to=f'{room}:bin')
+
+def broadcast_toggles(true_updates, false_updates, timestamp):
+    snapshot_cache.invalidate()
+    change_ring.record(true_updates, false_updates, timestamp)
+
+    by_chunk = split_by_chunk(true_updates, false_updates)
+    for chunk_id in by_chunk:
+        chunk_versions[chunk_id] = max(chunk_versions[chunk_id], timestamp)
+
+    # clients that never picked chunks get everything, like before
+    emit_batch(true_updates, false_updates, timestamp, 'all_chunks')
+    for chunk_id, (chunk_true, chunk_false) in by_chunk.items():
+        if chunk_subscriptions.subscribers[chunk_id]:
+            emit_batch(chunk_true, chunk_false, timestamp, f'chunk:{chunk_id}')
+
+def changes_since(since):
+    changes = change_ring.changes_since(since)
+    if changes is None:
+        return None
+    true_updates, false_updates, latest = changes
+    return {
+        'true_updates': true_updates,
+        'false_updates': false_updates,
+        'count': get_count(),
+        'timestamp': max(latest, since),
+    }
+
+def snapshot_response(snapshot):
+    if request.if_none_match.contains(snapshot.etag):
+        response = Response(status=304)
+    else:
+        encoding = pick_encoding(request.accept_encodings)
+        response = Response(snapshot.body_for(encoding), mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def requested_chunks(args):
+    # either chunks=1,2,3 or a start/end range of box indices, None if neither was asked for
+    if args.get('chunks') is not None:
+        chunks = args['chunks']
+        if isinstance(chunks, str):
+            chunks = chunks.split(',')
+        chunk_ids = [int(chunk_id) for chunk_id in chunks]
+    elif args.get('start') is not None and args.get('end') is not None:
+        start = max(int(args['start']), 0)
+        end = min(int(args['end']), TOTAL_CHECKBOXES)
+        chunk_ids = range(start // CHUNK_SIZE, (end + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    else:
+        return None
+    return sorted(set(chunk_id for chunk_id in chunk_ids if 0 <= chunk_id < TOTAL_CHUNKS))
+
+def chunk_snapshot(chunk_ids):
     timestamp = int(time.time() * 1000)  # Current time in milliseconds
-    return {'full_state': full_state, 'count': count, "timestamp": timestamp}
+    raw_chunks = get_raw_chunks(chunk_ids)
+    return {
+        'chunk_size': CHUNK_SIZE,
+        'chunks': {chunk_id: base64.b64encode(raw).decode('utf-8') for chunk_id, raw in raw_chunks.items()},
+        'versions': {chunk_id: chunk_versions[chunk_id] for chunk_id in chunk_ids},
+        'count': get_count(),
+        'timestamp': timestamp,
+    }
+
+def resync_clients():
+    # for when this worker missed toggles: full state for the clients that get every toggle,
+    # and a chunk_state with each of their chunks again for chunk subscribers
+    snapshot_cache.invalidate()
+    payload = snapshot_cache.get().payload
+    socketio.emit('full_state', payload, to='all_chunks')
+    socketio.emit('full_state', payload, to='all_chunks:bin')
+
+    chunk_ids = [chunk_id for chunk_id, subscribers in enumerate(chunk_subscriptions.subscribers) if subscribers]
+    if not chunk_ids:
+        return
+    snapshot = chunk_snapshot(chunk_ids)
+    for chunk_id in chunk_ids:
+        payload = {**snapshot, 'chunks': {chunk_id: snapshot['chunks'][chunk_id]},
+                   'versions': {chunk_id: snapshot['versions'][chunk_id]}}
+        socketio.emit('chunk_state', payload, to=f'chunk:{chunk_id}')
+        socketio.emit('chunk_state', payload, to=f'chunk:{chunk_id}:bin')
 
 @app.route('/api/initial-state')
 def get_initial_state():
-    return jsonify(state_snapshot())
+    try:
+        chunk_ids = requested_chunks(request.args)
+    except ValueError:
+        return jsonify({'error': 'chunks, start and end must be integers'}), 400
+    if chunk_ids is not None:
+        return jsonify(chunk_snapshot(chunk_ids))
+    return snapshot_response(snapshot_cache.get())
 
-def emit_full_state():
-    print("Emitting full state")
-    socketio.emit('full_state', state_snapshot())
+@socketio.on('get_chunks')
+def handle_get_chunks(data):
+    try:
+        chunk_ids = requested_chunks(data)
+    except:
+        return False
+    if chunk_ids is None:
+        return False
+    return chunk_snapshot(chunk_ids)
+
+@app.route('/api/changes')
+def get_changes():
+    since = request.args.get('since', type=int)
+    changes = None if since is None else changes_since(since)
+    if changes is None:
+        # the ring has rolled past this client, it needs everything
+        return snapshot_response(snapshot_cache.get())
+    return jsonify(changes)
+
+@socketio.on('request_changes')
+def handle_request_changes(data):
+    try:
+        since = int(data['since'])
+    except:
+        return state_snapshot()
+    changes = changes_since(since)
+    if changes is None:
+        return state_snapshot()
+    full_state_resync.ack(request.sid, changes['timestamp'])
+    return changes
+
+class FullStateResync:
+    def __init__(self, interval, buckets):
+        self.interval = interval
+        self.buckets = buckets
+        self.next_bucket = 0
+        self.members = [set() for _ in range(buckets)]
+        self.acks = {}
+
+    def bucket_for(self, sid):
+        return zlib.crc32(sid.encode('utf-8')) % self.buckets
+
+    def add(self, sid):
+        bucket = self.bucket_for(sid)
+        self.members[bucket].add(sid)
+        return f'resync:{bucket}'
+
+    def remove(self, sid):
+        self.members[self.bucket_for(sid)].discard(sid)
+        self.acks.pop(sid, None)
+
+    def ack(self, sid, timestamp):
+        self.acks[sid] = timestamp
+
+    def tick(self):
+        bucket = self.next_bucket
+        self.next_bucket = (bucket + 1) % self.buckets
+
+        # anyone who told us they were caught up within the last interval can skip this round
+        fresh_after = int(time.time() * 1000) - self.interval * 1000
+        members = self.members[bucket]
+        # chunk subscribers load their own slices and never want the whole bitset
+        skip = [sid for sid in members
+                if self.acks.get(sid, 0) >= fresh_after or chunk_subscriptions.is_subscribed(sid)]
+        recipients = len(members) - len(skip)
+        if recipients == 0:
+            return
+
+        snapshot = snapshot_cache.get()
+        socketio.emit('full_state', snapshot.payload, to=f'resync:{bucket}', skip_sid=skip or None)
+        FULL_STATE_BYTES.inc(recipients * len(snapshot.body))
+        print(f"Emitted full state to {recipients} clients in bucket {bucket} "
+              f"({recipients * len(snapshot.body)} bytes, skipped {len(skip)})")
+
+full_state_resync = FullStateResync(FULL_STATE_INTERVAL_SECONDS, FULL_STATE_BUCKETS)
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    # clients opt into binary frames with ?wire=binary or {wire: 'binary'} in the auth payload
+    wire = (auth or {}).get('wire') if isinstance(auth, dict) else None
+    if (wire or request.args.get('wire')) == 'binary':
+        binary_sids.add(request.sid)
+    join_room(full_state_resync.add(request.sid))
+    join_room(room_for(request.sid, 'all_chunks'))
+    CONNECTED_CLIENTS.inc(wire='binary' if request.sid in binary_sids else 'json')
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    CONNECTED_CLIENTS.dec(wire='binary' if request.sid in binary_sids else 'json')
+    full_state_resync.remove(request.sid)
+    chunk_subscriptions.remove(request.sid)
+    binary_sids.discard(request.sid)
+
+@socketio.on('subscribe_chunks')
+def handle_subscribe_chunks(data):
+    try:
+        chunk_ids = requested_chunks(data)
+    except:
+        return False
+    if not chunk_ids:
+        return False
+
+    was_subscribed = chunk_subscriptions.is_subscribed(request.sid)
+    added = chunk_subscriptions.subscribe(request.sid, chunk_ids, MAX_CHUNK_SUBSCRIPTIONS)
+    if added is None:
+        # a client wanting this much of the grid should stay on (or go back to) every toggle
+        return False
+    if not was_subscribed:
+        leave_room(room_for(request.sid, 'all_chunks'))
+    for chunk_id in added:
+        join_room(room_for(request.sid, f'chunk:{chunk_id}'))
+    # subscribing and loading happen together so nothing slips in between
+    return chunk_snapshot(chunk_ids)
+
+@socketio.on('unsubscribe_chunks')
+def handle_unsubscribe_chunks(data):
+    try:
+        chunk_ids = requested_chunks(data)
+    except:
+        return False
+    if chunk_ids is None:
+        return False
+
+    for chunk_id in chunk_subscriptions.unsubscribe(request.sid, chunk_ids):
+        leave_room(room_for(request.sid, f'chunk:{chunk_id}'))
+    if not chunk_subscriptions.is_subscribed(request.sid):
+        join_room(room_for(request.sid, 'all_chunks'))
+
+@socketio.on('ack_timestamp')
+def handle_ack_timestamp(data):
+    try:
+        full_state_resync.ack(request.sid, int(data['timestamp']))
+    except:
+        return False
 
 
 @socketio.on('toggle_bit')
 def handle_toggle(data):
-    if not allow_toggle(request.sid):
-        print(f"Rate limiting toggle request for {request.sid}")
+    redis_round_trips.count = 0
+    with TOGGLE_SECONDS.time():
+        outcome = toggle(data)
+    TOGGLES.inc(outcome=outcome)
+    if USE_REDIS:
+        TOGGLE_REDIS_ROUND_TRIPS.observe(redis_round_trips.count)
+    if outcome in ('throttled', 'rate_limited', 'invalid'):
+        return False
+
+heavy_hitters = HeavyHitters(top=HEAVY_HITTER_TOP, window_seconds=HEAVY_HITTER_WINDOW_SECONDS)
+# source -> when it first went over the limit
+throttled_sources = {}
+
+def is_heavy_hitter():
+    # counted before the sid limits, so attempts a bot spreads over many sids all add up here
+    forwarded_for = request.headers.get('X-Forwarded-For') if HEAVY_HITTER_TRUSTED_PROXIES else None
+    source = source_key(forwarded_for or request.remote_addr or "UNKNOWN_IP",
+                        HEAVY_HITTER_IPV6_PREFIX, max(HEAVY_HITTER_TRUSTED_PROXIES, 1))
+    rate = heavy_hitters.observe(source)
+    if not HEAVY_HITTER_LIMIT or rate <= HEAVY_HITTER_LIMIT:
         return False
+    if source not in throttled_sources:
+        throttled_sources[source] = time.time()
+        HEAVY_HITTERS_FLAGGED.inc()
+        print(f"Throttling {source}, {rate:.1f} toggles/s")
+    return True
+
+def share_heavy_hitters():
+    try:
+        heavy_hitters.merge(exchange_heavy_hitter_summaries(heavy_hitters.summary()))
+    except Exception as e:
+        print(f"Failed to share heavy hitters: {e}")
+    for source, since in list(throttled_sources.items()):
+        if heavy_hitters.rate(source) <= HEAVY_HITTER_LIMIT:
+            print(f"No longer throttling {source}, after {time.time() - since:.0f}s")
+            del throttled_sources[source]
+    HEAVY_HITTERS_THROTTLED.set(len(throttled_sources))
+
+def toggle(data):
+    if HEAVY_HITTERS:
+        with TOGGLE_STAGE_SECONDS.time(stage='heavy_hitters'):
+            throttled = is_heavy_hitter()
+        if throttled:
+            return 'throttled'
+
+    with TOGGLE_STAGE_SECONDS.time(stage='rate_limit'):
+        allowed = allow_toggle(request.sid)
+    if not allowed:
+        return 'rate_limited'
     
     try:
         index = int(data['index'])
     except:
-        return False
+        return 'invalid'
 
-    if index >= TOTAL_CHECKBOXES:
-        return False
+    if index < 0 or index >= TOTAL_CHECKBOXES:
+        return 'invalid'
     
-    did_toggle, new_value = _toggle_internal(index)
+    forwarded_for = request.headers.get('X-Forwarded-For') or "UNKNOWN_IP"
+    if BATCH_TOGGLES:
+        toggle_batcher.submit(index, forwarded_for)
+        return 'batched'
+
+    with TOGGLE_STAGE_SECONDS.time(stage='toggle'):
+        did_toggle, new_value = _toggle_internal(index)
     timestamp = int(time.time() * 1000)  # Current time in milliseconds
 
-    if did_toggle != 0:
-        forwarded_for = request.headers.get('X-Forwarded-For') or "UNKNOWN_IP"
+    if did_toggle == 0:
+        return 'unchanged'
+    with TOGGLE_STAGE_SECONDS.time(stage='log'):
         log_checkbox_toggle(forwarded_for, index, new_value)
+    with TOGGLE_STAGE_SECONDS.time(stage='publish'):
         emit_toggle(index, new_value, timestamp)
+    return 'applied'
+
+def has_token(token):
+    supplied = request.headers.get('Authorization', '')
+    return hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {token}'.encode('utf-8'))
+
+@app.route('/metrics')
+def get_metrics():
+    if not METRICS_TOKEN:
+        return Response(status=404)
+    if not has_token(METRICS_TOKEN):
+        return Response(status=401)
+    return Response(metrics.registry.render(WORKER_NAME), mimetype='text/plain; version=0.0.4')
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+@app.route('/debug/profile', methods=['POST'])
+def run_profile():
+    # profiles whichever worker picked up the request, X-Worker says which one that was
+    if not ADMIN_TOKEN:
+        return Response(status=404)
+    if not has_token(ADMIN_TOKEN):
+        return Response(status=401)
+    seconds = min(request.args.get('seconds', PROFILE_SECONDS, type=float), 300)
+    if not profiler.start():
+        return jsonify({'error': 'already profiling'}), 409
+    socketio.sleep(seconds)
+    return Response(profiler.stop(), mimetype='text/plain', headers={'X-Worker': WORKER_NAME})
+
+@app.route('/debug/heavy-hitters')
+def get_heavy_hitters():
+    # the heaviest sources across every worker, as of this worker's last merge
+    if not ADMIN_TOKEN:
+        return Response(status=404)
+    if not has_token(ADMIN_TOKEN):
+        return Response(status=401)
+    sources = [{
+        'source': source,
+        'toggles_per_second': round(rate, 2),
+        'throttled_since': throttled_sources.get(source),
+    } for rate, source in heavy_hitters.top()]
+    return jsonify({
+        'worker': WORKER_NAME,
+        'limit': HEAVY_HITTER_LIMIT,
+        'window_seconds': HEAVY_HITTER_WINDOW_SECONDS,
+        'sources': sources,
+    })
+
+static_manifest = StaticManifest(REACT_BUILD_DIRECTORY, STATIC_PRELOAD_BYTES, STATIC_MAX_AGE_SECONDS)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
-    if path != "" and os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
+    # anything that isn't a file in the build gets index.html and the frontend sorts it out
+    asset = static_manifest.get(path) or static_manifest.get('index.html')
+    if asset is None:
+        return Response(status=404)
+
+    if request.if_none_match.contains(asset.etag):
+        STATIC_RESPONSES.inc(source='not_modified')
+        response = Response(status=304)
+    elif asset.is_preloaded():
+        STATIC_RESPONSES.inc(source='memory')
+        encoding = asset.encoding_for(request.accept_encodings)
+        response = Response(asset.encoded[encoding], mimetype=asset.content_type)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
     else:
-        return send_file(os.path.join(app.static_folder, 'index.html'))
-    
+        STATIC_RESPONSES.inc(source='disk')
+        try:
+            response = send_file(asset.path, mimetype=asset.content_type, etag=False, conditional=False)
+        except FileNotFoundError:
+            # a new build is halfway in, the next reload will sort it out
+            return Response(status=404)
+    response.set_etag(asset.etag)
+    response.headers['Cache-Control'] = asset.cache_control
+    if len(asset.encoded) > 1:
+        response.vary.add('Accept-Encoding')
+    return response
+
+def reload_static_assets():
+    try:
+        if static_manifest.reload():
+            print(f"Loaded {len(static_manifest.assets)} files from {REACT_BUILD_DIRECTORY}")
+    except Exception as e:
+        print(f"Failed to load {REACT_BUILD_DIRECTORY}: {e}")
+
 
 #@socketio.on('connect')
 #def handle_connect():
@@ -310,58 +1603,270 @@ def serve(path):
         #return False
 
 def emit_state_updates():
-    scheduler.add_job(emit_full_state, 'interval', seconds=45)
+    if FULL_STATE_INTERVAL_SECONDS > 0:
+        scheduler.add_job(full_state_resync.tick, 'interval',
+                          seconds=FULL_STATE_INTERVAL_SECONDS / FULL_STATE_BUCKETS)
     scheduler.start()
 
 emit_state_updates()
 
-def handle_redis_messages():
-    if USE_REDIS:
-        message_count = 0
-        updates = []
+def is_index(value):
+    return type(value) is int and 0 <= value < TOTAL_CHECKBOXES
+
+def is_toggle_update(update):
+    # [index, value, timestamp] from a single toggle, or [true_updates, false_updates, timestamp]
+    if not isinstance(update, list) or len(update) != 3 or type(update[2]) is not int:
+        return False
+    first, second, _ = update
+    if isinstance(first, list):
+        return isinstance(second, list) and all(map(is_index, first)) and all(map(is_index, second))
+    return is_index(first)
+
+class ToggleConsumer:
+    def __init__(self, flush_size, flush_ms, max_lag_ms):
+        self.flush_size = flush_size
+        self.flush_seconds = flush_ms / 1000
+        self.max_lag_ms = max_lag_ms
+        self.pending = []
+        self.deadline = None
+        # when this process got the oldest pending message
+        self.received = None
+        # one subscription per shard, all feeding the same pending batch
+        self.pubsubs = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.messages = 0
+        self.batches = 0
+        self.dropped = 0
+        self.last_lag_ms = 0
+        self.max_lag_ms_seen = 0
+        self.max_depth = 0
+
+    def run(self, shard):
         while True:
-            message = pubsub.get_message(timeout=0.01)
-            if message is None:
-                # No more messages available
-                break
+            try:
+                # (re)subscribe on whichever replica is healthy right now
+                if shard.number in self.pubsubs:
+                    self.pubsubs[shard.number].close()
+                self.pubsubs[shard.number] = open_toggle_pubsub(shard)
+                self.consume(self.pubsubs[shard.number])
+            except Exception as e:
+                print(f"Toggle consumer failed, restarting: {e}")
+                socketio.sleep(1)
 
-            if message['type'] == 'message':
-                try:
-                    data = json.loads(message['data'])
-                    updates.append(data)
-                    message_count += 1
-                except json.JSONDecodeError:
-                    print(f"Failed to decode message: {message['data']}")
-
-            if message_count >= 600:
-                break
-
-        if message_count > 0:
-            true_updates = []
-            false_updates = []
-            max_timestamp = 0
-            for update in updates:
-                if len(update) != 3: # backwards compatibility
-                    continue
-                else:
-                    index, value, timestamp = update
-                    max_timestamp = max(max_timestamp, timestamp)
-                if value:
-                    true_updates.append(index)
-                else:
-                    false_updates.append(index)
-            to_broadcast = [true_updates, false_updates, max_timestamp]
-
-            socketio.emit('batched_bit_toggles', to_broadcast)
-            # print(f"Processed {message_count} messages")
+    def consume(self, pubsub):
+        while True:
+            # block on the socket until the next message or until the pending batch is due
+            timeout = 1.0 if self.deadline is None else max(self.deadline - time.time(), 0)
+            message = pubsub.get_message(timeout=timeout)
+            if message is not None and message['type'] == 'message':
+                PUBSUB_MESSAGES.inc()
+                self.add(message['data'])
+
+            if self.pending and (len(self.pending) >= self.flush_size or time.time() >= self.deadline):
+                self.flush()
+
+    def add(self, data):
+        try:
+            if is_binary(data):
+                update = decode_toggles(data)
+            else:
+                update = json.loads(data)
+        except (json.JSONDecodeError, ValueError):
+            print(f"Failed to decode message: {data}")
+            return
+        if not is_toggle_update(update): # backwards compatibility
+            return
+
+        if not self.pending:
+            self.received = time.time()
+            self.deadline = self.received + self.flush_seconds
+        self.pending.append(update)
+        self.messages += 1
+        self.max_depth = max(self.max_depth, len(self.pending))
+
+    def flush(self):
+        updates = self.pending
+        received = self.received
+        self.pending = []
+        self.deadline = None
+        self.received = None
+
+        # coalesced in arrival order, so a box toggled more than once in the batch ends up
+        # with its last value, same as in ToggleBatcher.flush
+        final_values = {}
+        max_timestamp = 0
+        min_timestamp = None
+        for update in updates:
+            if isinstance(update[0], list):
+                # already batched by a ToggleBatcher, or a binary message
+                batch_true, batch_false, timestamp = update
+                for index in batch_true:
+                    final_values[index] = True
+                for index in batch_false:
+                    final_values[index] = False
+            else:
+                index, value, timestamp = update
+                final_values[index] = bool(value)
+            max_timestamp = max(max_timestamp, timestamp)
+            min_timestamp = timestamp if min_timestamp is None else min(min_timestamp, timestamp)
+
+        # end to end latency, from the toggle being stamped to us sending it out. Only a metric,
+        # the stamp comes from another host's clock
+        PUBSUB_LAG_SECONDS.observe(max(time.time() * 1000 - min_timestamp, 0) / 1000)
+        PUBSUB_BATCH_MESSAGES.observe(len(updates))
+        # how far behind we are is measured on our own clock, from when we got the oldest message
+        lag_ms = int((time.time() - received) * 1000)
+        self.last_lag_ms = lag_ms
+        self.max_lag_ms_seen = max(self.max_lag_ms_seen, lag_ms)
+        if lag_ms > self.max_lag_ms:
+            self.drop_and_resync(lag_ms)
+            return
+
+        if LOCAL_MIRROR:
+            for index, value in final_values.items():
+                mirror.apply(index, value)
+        true_updates = [index for index, value in final_values.items() if value]
+        false_updates = [index for index, value in final_values.items() if not value]
+        # every worker gets every toggle here, one journal per directory is plenty
+        if PERSIST and persistence.is_leader():
+            persistence.record_many(true_updates, false_updates)
+        self.batches += 1
+        broadcast_toggles(true_updates, false_updates, max_timestamp)
+
+    def drop_and_resync(self, lag_ms):
+        # we're too far behind for deltas to be worth it: throw away the backlog,
+        # reload the bitset and give everyone a fresh snapshot instead
+        dropped = 0
+        for pubsub in self.pubsubs.values():
+            while pubsub.get_message(timeout=0) is not None:
+                dropped += 1
+        self.dropped += dropped
+        PUBSUB_DROPPED.inc(dropped)
+        print(f"Toggle consumer is {lag_ms}ms behind, dropped {dropped} messages and resyncing")
+        # the change ring is missing whatever we just threw away
+        change_ring.drop_before(int(time.time() * 1000))
+        if LOCAL_MIRROR:
+            resync_mirror()
+        resync_clients()
+
+    def report(self):
+        print(f"Toggle consumer: {self.messages} messages in {self.batches} batches, "
+              f"max depth {self.max_depth}, last lag {self.last_lag_ms}ms, "
+              f"max lag {self.max_lag_ms_seen}ms, dropped {self.dropped}")
+        self.reset_stats()
+
+toggle_consumer = ToggleConsumer(PUBSUB_FLUSH_SIZE, PUBSUB_FLUSH_MS, PUBSUB_MAX_LAG_MS)
 
 def setup_redis_listener():
     if USE_REDIS:
-        print("Redis listener job added to scheduler")
-        scheduler.add_job(handle_redis_messages, 'interval', seconds=0.2)
+        print("Redis listener started")
+        for shard in shards:
+            socketio.start_background_task(toggle_consumer.run, shard)
+        scheduler.add_job(toggle_consumer.report, 'interval', seconds=60)
+        scheduler.add_job(check_replicas, 'interval', seconds=REDIS_HEALTH_CHECK_SECONDS)
+        scheduler.add_job(report_redis_pools, 'interval', seconds=60)
+        if LOCAL_MIRROR:
+            if disk_state is None:
+                resync_mirror()
+            else:
+                # serve what we had on disk right away and catch up with redis in the background
+                socketio.start_background_task(resync_mirror)
+            scheduler.add_job(resync_mirror, 'interval', seconds=MIRROR_RESYNC_SECONDS)
+        if LOCAL_RATE_LIMIT_PRECHECK:
+            scheduler.add_job(local_toggle_limiter.prune, 'interval', seconds=60)
 
 setup_redis_listener()
 
+def setup_worker_fanout():
+    if not USE_REDIS:
+        print(f"Sharing state with other workers through {SHARED_STATE_DIR}")
+        socketio.start_background_task(listen_to_workers)
+        scheduler.add_job(report_fanout, 'interval', seconds=60)
+        atexit.register(fanout.close)
+
+setup_worker_fanout()
+
+def setup_toggle_batcher():
+    if BATCH_TOGGLES:
+        print("Toggle batcher started")
+        socketio.start_background_task(toggle_batcher.run)
+        scheduler.add_job(toggle_batcher.report, 'interval', seconds=60)
+
+setup_toggle_batcher()
+
+def setup_heavy_hitters():
+    if HEAVY_HITTERS:
+        print(f"Watching for heavy hitters, throttling over {HEAVY_HITTER_LIMIT} toggles/s")
+        scheduler.add_job(share_heavy_hitters, 'interval', seconds=HEAVY_HITTER_MERGE_SECONDS)
+
+setup_heavy_hitters()
+
+def setup_rate_limiters():
+    if USE_REDIS:
+        try:
+            check_rate_limiters()
+        except redis.RedisError as e:
+            print(f"Couldn't check the rate limiters: {e}")
+
+setup_rate_limiters()
+
+def setup_static_assets():
+    static_manifest.reload(force=True)
+    print(f"Serving {len(static_manifest.assets)} files from {REACT_BUILD_DIRECTORY} out of memory")
+    if STATIC_RELOAD_SECONDS > 0:
+        scheduler.add_job(reload_static_assets, 'interval', seconds=STATIC_RELOAD_SECONDS)
+
+setup_static_assets()
+
+def setup_checkbox_log():
+    if LOG_SINK == 'file':
+        print(f"Writing checkbox logs to {CHECKBOX_LOG_DIR}")
+        socketio.start_background_task(flush_checkbox_log)
+        atexit.register(checkbox_log.flush)
+        if KEYFRAME_SECONDS > 0:
+            scheduler.add_job(write_live_keyframe, 'interval', seconds=KEYFRAME_SECONDS)
+
+setup_checkbox_log()
+
+def flush_journal():
+    try:
+        PERSIST_JOURNAL_RECORDS.inc(persistence.flush())
+    except Exception as e:
+        print(f"Failed to write the toggle journal: {e}")
+
+def snapshot_to_disk():
+    try:
+        started = time.perf_counter()
+        if persistence.snapshot(get_raw_state) is not None:
+            PERSIST_SNAPSHOT_TIME.observe(time.perf_counter() - started)
+    except Exception as e:
+        print(f"Failed to snapshot the bitset: {e}")
+
+def setup_persistence():
+    if PERSIST:
+        print(f"Persisting the bitset to {PERSIST_DIR}")
+        scheduler.add_job(flush_journal, 'interval', seconds=LOG_FLUSH_SECONDS)
+        scheduler.add_job(snapshot_to_disk, 'interval', seconds=PERSIST_SNAPSHOT_SECONDS)
+        # atexit runs these last first: flush the journal, then take a snapshot if we're the writer
+        atexit.register(snapshot_to_disk)
+        atexit.register(flush_journal)
+
+setup_persistence()
+
+def toggle_profiler(signum, frame):
+    if profiler.running:
+        profiler.stop()
+        print(f"Profiler stopped, wrote {profiler.write(PROFILE_DIR, WORKER_NAME)}")
+    elif profiler.start():
+        print(f"Profiler started on {WORKER_NAME}, send SIGUSR2 again to stop it")
+
+def setup_profiler():
+    signal.signal(signal.SIGUSR2, toggle_profiler)
+
+setup_profiler()
+
 if __name__ == '__main__':
     set_bit(0, True)
     set_bit(1, True)
@@ -0,0 +1,136 @@
+import fcntl
+import mmap
+import os
+import socket
+import time
+
+from bitarray import bitarray
+
+# Checkbox state shared by every server.py process on one box, for running without redis.
+#
+# The bitset lives in a memory-mapped file that every process maps, so reads are plain
+# memory reads and the count is a popcount of the bitset rather than a second value
+# that has to be kept in step with it. Python has no compare-and-swap on shared memory,
+# so a toggle takes an fcntl lock on just the byte it changes; two processes only ever
+# wait on each other when they click boxes in the same byte.
+#
+# Toggles are fanned out between processes over unix datagram sockets, one per process
+# in a shared directory. A full receiver drops the message instead of blocking the
+# sender. The mapped bitset is always right, but that worker's clients missed the
+# toggles, so the next message it gets from us is DROPPED_NOTICE to tell it so.
+
+class SharedBitset:
+    def __init__(self, path, size, initialize=None):
+        # initialize(bitset) fills in a freshly created bitset, before any other process can use it
+        if size % 8:
+            raise ValueError("SharedBitset sizes have to be whole bytes")
+        self.size = size
+        nbytes = size // 8
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # flock doesn't interact with the lockf byte locks below, it only guards creating the file
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            created = os.fstat(self.fd).st_size < nbytes
+            if created:
+                os.ftruncate(self.fd, nbytes)
+            self.mm = mmap.mmap(self.fd, nbytes)
+            # big-endian like redis, so the raw bytes mean the same thing on both backends
+            self.bitset = bitarray(buffer=self.mm, endian='big')
+            if created and initialize is not None:
+                initialize(self.bitset)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def lock(self, index):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, index // 8)
+
+    def unlock(self, index):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, index // 8)
+
+    def toggle(self, index):
+        # returns the new value, or None once every box is checked
+        self.lock(index)
+        try:
+            if self.bitset.all():
+                return None
+            value = not self.bitset[index]
+            self.bitset[index] = value
+            return value
+        finally:
+            self.unlock(index)
+
+    def set(self, index, value):
+        # returns whether the bit changed
+        self.lock(index)
+        try:
+            if self.bitset[index] == bool(value):
+                return False
+            self.bitset[index] = bool(value)
+            return True
+        finally:
+            self.unlock(index)
+
+    def count(self):
+        return self.bitset.count()
+
+# can't be mistaken for a toggle_codec message, those start with its magic byte
+DROPPED_NOTICE = b'dropped'
+
+class WorkerFanout:
+    def __init__(self, directory, name, refresh_seconds=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'{name}.sock')
+        self.refresh_seconds = refresh_seconds
+        self.peers = []
+        # peers that missed a message and haven't been told yet
+        self.behind = set()
+        self.refreshed_at = 0
+        self.sent = 0
+        self.dropped = 0
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.receiver.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def refresh_peers(self):
+        self.peers = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith('.sock') and os.path.join(self.directory, name) != self.path]
+        self.refreshed_at = time.time()
+
+    def publish(self, message):
+        if time.time() - self.refreshed_at >= self.refresh_seconds:
+            self.refresh_peers()
+        for peer in list(self.peers):
+            try:
+                if peer in self.behind:
+                    self.sender.sendto(DROPPED_NOTICE, peer)
+                    self.behind.discard(peer)
+                self.sender.sendto(message, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # that process is gone, don't leave its socket lying around
+                self.peers.remove(peer)
+                self.behind.discard(peer)
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                self.dropped += 1
+                self.behind.add(peer)
+
+    def receive(self, max_size=1 << 20):
+        return self.receiver.recv(max_size)
+
+    def close(self):
+        self.receiver.close()
+        self.sender.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
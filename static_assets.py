@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# An in-memory index of the React build in dist/, so serving the frontend doesn't stat or
+# open anything per request. Every file gets a content hash (the ETag, so every worker
+# hands out the same one) and a Cache-Control header picked from its name. Files up to
+# preload_bytes are kept in memory along with gzip and brotli versions if those come out
+# smaller; bigger ones are still streamed from disk.
+#
+# If the build already has foo.js.br or foo.js.gz next to foo.js, those are used instead
+# of compressing here.
+#
+# Parcel puts a content hash in every bundle's name (index.1a2b3c4d.js), so those can be
+# cached forever. Anything else, index.html above all, has to be revalidated.
+
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.[A-Za-z0-9]+$")
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/manifest+json",
+                      "application/xml", "image/svg+xml")
+PRECOMPRESSED = {".br": "br", ".gz": "gzip"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+def cache_control_for(name, max_age_seconds):
+    if HASHED_NAME.search(name):
+        return IMMUTABLE
+    if name.endswith(".html"):
+        return "no-cache"
+    return f"public, max-age={max_age_seconds}"
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+class StaticAsset:
+    def __init__(self, name, path, content_type, cache_control, etag, body=None):
+        self.name = name
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = etag
+        # encoding -> bytes, empty when the file is too big to keep around
+        self.encoded = {} if body is None else {"identity": body}
+
+    def is_preloaded(self):
+        return "identity" in self.encoded
+
+    def encoding_for(self, accept_encodings):
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and encoding in accept_encodings:
+                return encoding
+        return "identity"
+
+def load_asset(directory, name, precompressed, preload_bytes, max_age_seconds):
+    path = os.path.join(directory, name)
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    cache_control = cache_control_for(name, max_age_seconds)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > preload_bytes:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+            return StaticAsset(name, path, content_type, cache_control, digest.hexdigest()[:20])
+        body = f.read()
+    digest.update(body)
+    asset = StaticAsset(name, path, content_type, cache_control, digest.hexdigest()[:20], body)
+
+    for encoding, variant in precompressed.items():
+        with open(variant, "rb") as f:
+            asset.encoded[encoding] = f.read()
+    if is_compressible(content_type):
+        if "gzip" not in asset.encoded:
+            asset.encoded["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None and "br" not in asset.encoded:
+            asset.encoded["br"] = brotli.compress(body, quality=9)
+    # not worth a Content-Encoding if it barely helps
+    for encoding in ("br", "gzip"):
+        if encoding in asset.encoded and len(asset.encoded[encoding]) >= 0.9 * len(body):
+            del asset.encoded[encoding]
+    return asset
+
+class StaticManifest:
+    def __init__(self, directory, preload_bytes, max_age_seconds):
+        self.directory = directory
+        self.preload_bytes = preload_bytes
+        self.max_age_seconds = max_age_seconds
+        self.assets = {}
+        # the names in dist/ as of the last reload, as opposed to ones kept from the build before
+        self.build = set()
+        self.signature = None
+        self.last_scan = None
+
+    def scan(self):
+        # (name, size, mtime) for every file, cheap enough to compare every couple of seconds
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((os.path.relpath(path, self.directory).replace(os.sep, "/"), stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(files))
+
+    def reload(self, force=False):
+        # rebuilds the index once dist/ has changed and then stayed put for one scan,
+        # so a deploy isn't picked up halfway through being copied
+        signature = self.scan()
+        settled = force or signature == self.last_scan
+        self.last_scan = signature
+        if signature == self.signature or not settled:
+            return False
+
+        names = {name for name, _, _ in signature}
+        assets = {}
+        for name in names:
+            base, extension = os.path.splitext(name)
+            if extension in PRECOMPRESSED and base in names:
+                continue
+            precompressed = {encoding: os.path.join(self.directory, f"{name}{suffix}")
+                             for suffix, encoding in PRECOMPRESSED.items() if f"{name}{suffix}" in names}
+            try:
+                assets[name] = load_asset(self.directory, name, precompressed, self.preload_bytes, self.max_age_seconds)
+            except FileNotFoundError:
+                continue
+
+        # clients still running the last build ask for its bundles until they reload
+        build = set(assets)
+        for name in self.build - build:
+            asset = self.assets[name]
+            if asset.cache_control == IMMUTABLE and asset.is_preloaded():
+                assets[name] = asset
+        self.assets = assets
+        self.build = build
+        self.signature = signature
+        return True
+
+    def get(self, name):
+        return self.assets.get(name)
@@ -0,0 +1,77 @@
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+# Compact binary form of a [true_updates, false_updates, timestamp] batch.
+#
+#   magic (1 byte) | version (1 byte) | timestamp ms (uint64)
+#   then for true_updates and then false_updates:
+#   count (uint32) | width (1 byte) | count deltas, each `width` bytes
+#
+# Indices are sorted and stored as deltas from the previous one, using the
+# smallest width (1, 2 or 4 bytes) that fits every delta in that list.
+# Everything is little-endian. The magic byte can't start a JSON message, so
+# both formats can share a channel. Anything that doesn't decode to exactly
+# that raises ValueError.
+
+MAGIC = 0xB1
+VERSION = 1
+
+HEADER = struct.Struct('<BBQ')
+LIST_HEADER = struct.Struct('<IB')
+TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+
+def is_binary(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and len(data) > 0 and data[0] == MAGIC
+
+def _width_for(largest):
+    if largest < 1 << 8:
+        return 1
+    if largest < 1 << 16:
+        return 2
+    return 4
+
+def _encode_indices(indices, out):
+    indices = sorted(indices)
+    deltas = [b - a for a, b in zip([0] + indices, indices)]
+    width = _width_for(max(deltas, default=0))
+    packed = array(TYPECODES[width], deltas)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    out += LIST_HEADER.pack(len(packed), width)
+    out += packed.tobytes()
+
+def _decode_indices(data, offset):
+    if len(data) < offset + LIST_HEADER.size:
+        raise ValueError("Toggle batch ends in a list header")
+    count, width = LIST_HEADER.unpack_from(data, offset)
+    if width not in TYPECODES:
+        raise ValueError(f"Toggle batch has deltas {width} bytes wide")
+    offset += LIST_HEADER.size
+    end = offset + count * width
+    if len(data) < end:
+        raise ValueError(f"Toggle batch is missing {end - len(data)} bytes of deltas")
+    packed = array(TYPECODES[width])
+    packed.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return list(accumulate(packed)), end
+
+def encode_toggles(true_updates, false_updates, timestamp):
+    out = bytearray(HEADER.pack(MAGIC, VERSION, timestamp))
+    _encode_indices(true_updates, out)
+    _encode_indices(false_updates, out)
+    return bytes(out)
+
+def decode_toggles(data):
+    if len(data) < HEADER.size:
+        raise ValueError("Toggle batch is shorter than its header")
+    magic, version, timestamp = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} toggle batch")
+    true_updates, offset = _decode_indices(data, HEADER.size)
+    false_updates, offset = _decode_indices(data, offset)
+    if offset != len(data):
+        raise ValueError(f"Toggle batch has {len(data) - offset} bytes left over")
+    return [true_updates, false_updates, timestamp]